@@ -0,0 +1,283 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+"""Benchmarks of migrant engine hot paths
+
+Runs engine against synthetic in-memory backend and generated script
+repository, and writes timings as JSON, so that they can be compared between
+runs::
+
+    python benchmarks/bench_engine.py --dbs 1000 --scripts 200 -o results.json
+"""
+from typing import Any, Callable, Dict, List, Optional
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from migrant import repository as repository_module
+from migrant.backend import MigrantBackend
+from migrant.engine import MigrantEngine
+from migrant.repository import DirectoryRepository
+
+# How migrations are applied to generated databases
+DISTRIBUTIONS = ("current", "behind", "fresh", "mixed")
+
+
+class MemoryBackend(MigrantBackend[str, str]):
+    """Backend, that keeps applied migrations in memory
+
+    Each backend call sleeps for `latency` seconds to simulate round trip to
+    the database. Changes, made in pool workers, are not seen by the parent
+    process.
+    """
+
+    thread_safe = True
+
+    def __init__(self, applied: Dict[str, List[str]], latency: float = 0.0) -> None:
+        self.applied = applied
+        self.latency = latency
+
+    def _call(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def generate_connections(self) -> List[str]:
+        return list(self.applied)
+
+    def begin(self, db: str) -> str:
+        self._call()
+        return db
+
+    def commit(self, db: str) -> None:
+        self._call()
+
+    def list_migrations(self, db: str) -> List[str]:
+        self._call()
+        return list(self.applied[db])
+
+    def push_migration(self, db: str, migration: str) -> None:
+        self._call()
+        self.applied[db].append(migration)
+
+    def pop_migration(self, db: str, migration: str) -> None:
+        self._call()
+        self.applied[db].remove(migration)
+
+    def push_migrations(self, db: str, migrations: List[str]) -> None:
+        self._call()
+        self.applied[db].extend(migrations)
+
+
+def make_repository(directory: str, nscripts: int) -> DirectoryRepository:
+    """Create repository with `nscripts` trivial scripts"""
+    repo = DirectoryRepository(directory)
+    repo.init()
+    for n in range(nscripts):
+        repo.new_script(f"Script {n}")
+    return repo
+
+
+def make_applied(
+    dbs: int, names: List[str], distribution: str, behind: int, seed: int
+) -> Dict[str, List[str]]:
+    """Return applied migrations for each database
+
+    "current" databases have all scripts applied, "behind" ones miss last
+    `behind` scripts, "fresh" ones were never migrated, and "mixed" ones are
+    random mix of these.
+    """
+    rnd = random.Random(seed)
+    applied = {}
+    for n in range(dbs):
+        kind = distribution
+        if kind == "mixed":
+            kind = rnd.choice(DISTRIBUTIONS[:3])
+        if kind == "current":
+            migrations = ["INITIAL"] + names
+        elif kind == "behind":
+            migrations = ["INITIAL"] + names[: max(len(names) - behind, 0)]
+        else:
+            migrations = []
+        applied[f"db{n:06}"] = migrations
+    return applied
+
+
+def timeit(func: Callable[[], Any], repeat: int) -> float:
+    """Return best time of `repeat` runs of `func`"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    tmpdir = tempfile.mkdtemp(prefix="migrant-bench")
+    results: List[Dict[str, Any]] = []
+
+    def record(name: str, seconds: float, items: int, **params: Any) -> None:
+        result = {
+            "name": name,
+            "seconds": seconds,
+            "items": items,
+            "per_item": seconds / items if items else None,
+        }
+        result.update(params)
+        results.append(result)
+        print(f"{name:<32} {seconds:10.4f}s  {params or ''}", file=sys.stderr)
+
+    try:
+        repo = make_repository(os.path.join(tmpdir, "scripts"), args.scripts)
+        revids = repo.list_script_ids()
+        names = [repo.script_name(revid) for revid in revids]
+
+        record(
+            "list_script_ids",
+            timeit(repo.list_script_ids, args.repeat),
+            len(revids),
+        )
+
+        def load_cold() -> None:
+            repository_module._script_cache.clear()
+            fresh = DirectoryRepository(repo.directory)
+            for revid in revids:
+                fresh.load_script(revid).module
+
+        def load_warm() -> None:
+            for revid in revids:
+                repo.load_script(revid).module
+
+        load_warm()
+        record("load_script/cold", timeit(load_cold, args.repeat), len(revids))
+        record("load_script/warm", timeit(load_warm, args.repeat), len(revids))
+
+        applied = make_applied(
+            args.dbs, names, args.distribution, args.behind, args.seed
+        )
+        # Backend calls are timed with injected latency in update only
+        backend = MemoryBackend(applied)
+        engine = MigrantEngine(backend, repo, {}, processes=1)
+        target = engine.pick_rev_id(None)
+        initialized = [db for db, migrations in applied.items() if migrations]
+
+        def calc_actions() -> None:
+            engine._plans.clear()
+            for db in initialized:
+                engine.calc_actions(db, target)
+
+        record("calc_actions", timeit(calc_actions, args.repeat), len(initialized))
+
+        def initialize_db() -> None:
+            scratch = MemoryBackend({db: [] for db in applied})
+            scratch_engine = MigrantEngine(scratch, repo, {}, processes=1)
+            for db in scratch.applied:
+                scratch_engine.initialize_db(db, target)
+
+        record("initialize_db", timeit(initialize_db, args.repeat), len(applied))
+
+        for executor in args.executors:
+            for processes in args.processes:
+
+                def update() -> None:
+                    state = {db: list(m) for db, m in applied.items()}
+                    engine = MigrantEngine(
+                        MemoryBackend(state, args.latency),
+                        repo,
+                        {},
+                        processes=processes,
+                        executor=executor,
+                    )
+                    engine.update()
+
+                record(
+                    "update",
+                    timeit(update, args.repeat),
+                    len(applied),
+                    processes=processes,
+                    executor=executor,
+                )
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            "dbs": args.dbs,
+            "scripts": args.scripts,
+            "distribution": args.distribution,
+            "behind": args.behind,
+            "latency": args.latency,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+
+def int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",")]
+
+
+parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+parser.add_argument("--dbs", type=int, default=1000, help="Number of databases")
+parser.add_argument("--scripts", type=int, default=100, help="Number of scripts")
+parser.add_argument(
+    "--distribution",
+    choices=DISTRIBUTIONS,
+    default="behind",
+    help="How migrations are applied to databases",
+)
+parser.add_argument(
+    "--behind",
+    type=int,
+    default=2,
+    help="Number of scripts, not yet applied to databases, that are behind",
+)
+parser.add_argument(
+    "--latency",
+    type=float,
+    default=0.0,
+    help="Seconds, each backend call takes in update benchmark",
+)
+parser.add_argument(
+    "--processes",
+    type=int_list,
+    default=[1, 2, 4],
+    help="Comma separated pool sizes for update benchmark",
+)
+parser.add_argument(
+    "--executors",
+    type=lambda v: v.split(","),
+    default=["process"],
+    help="Comma separated executors for update benchmark",
+)
+parser.add_argument("--repeat", type=int, default=3, help="Runs of each benchmark")
+parser.add_argument("--seed", type=int, default=0, help="Random seed")
+parser.add_argument(
+    "-o", "--output", default="-", help="Write JSON results to file, - for stdout"
+)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parser.parse_args(argv)
+    data = run(args)
+    if args.output == "-":
+        json.dump(data, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(data, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+"""Asynchronous backends and engine
+
+Asynchronous engine migrates many databases concurrently on a single event
+loop. Migration scripts may define `up`, `down` and test functions either as
+regular or as `async` functions.
+"""
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable
+from typing import Dict, Generic, Iterable, List, Optional, Set, Tuple, Union
+import asyncio
+import inspect
+import logging
+import time
+
+from migrant import exceptions, events, report
+from migrant.backend import DBN, DBC
+from migrant.engine import Actions, EngineBase, canonical_rev_id
+from migrant.events import MigrantObserver
+from migrant.journal import Journal
+from migrant.report import DbResult, FleetPlan, UpdateReport
+from migrant.repository import Repository
+
+log = logging.getLogger(__name__)
+
+# Number of databases, processed concurrently by default
+DEFAULT_CONCURRENCY = 100
+
+
+class AsyncMigrantBackend(Generic[DBN, DBC]):
+    """Base interface for asynchronous backend implementations
+
+    The same as `MigrantBackend`, but database operations are coroutines.
+    """
+
+    def generate_connections(self) -> Union[Iterable[DBN], AsyncIterable[DBN]]:
+        """Generate connections to process
+
+        Can be either regular or asynchronous iterable.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def database_key(self, db: DBN) -> str:
+        """Return key, identifying the database, see
+        `MigrantBackend.database_key`"""
+        return str(db)
+
+    async def begin(self, db: DBN) -> DBC:
+        """Begin the migration
+
+        Can raise DatabaseUnavailable exception. In this case, migration will
+        be skipped for this database.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    async def commit(self, db: DBC) -> None:
+        """Called on successful completion of a migration"""
+        pass
+
+    async def abort(self, db: DBC) -> None:
+        """Called when migration have failed"""
+        pass
+
+    async def cleanup(self, db: DBC) -> None:
+        """Called when all work on database is done"""
+        pass
+
+    async def list_migrations(self, db: DBC) -> List[str]:
+        raise NotImplementedError  # pragma: no cover
+
+    async def push_migration(self, db: DBC, migration: str) -> None:
+        raise NotImplementedError  # pragma: no cover
+
+    async def pop_migration(self, db: DBC, migration: str) -> None:
+        raise NotImplementedError  # pragma: no cover
+
+    async def push_migrations(self, db: DBC, migrations: List[str]) -> None:
+        """Record several migrations as applied, in given order"""
+        for migration in migrations:
+            await self.push_migration(db, migration)
+
+    async def pop_migrations(self, db: DBC, migrations: List[str]) -> None:
+        """Remove several migrations from applied ones, in given order"""
+        for migration in migrations:
+            await self.pop_migration(db, migration)
+
+
+class AsyncMigrantEngine(EngineBase, Generic[DBN, DBC]):
+    """Engine, that migrates databases concurrently on the event loop
+
+    At most `concurrency` databases are processed at the same time.
+    """
+
+    def __init__(
+        self,
+        backend: AsyncMigrantBackend[DBN, DBC],
+        repository: Repository,
+        config: Dict[str, str],
+        dry_run: bool = False,
+        concurrency: Optional[int] = None,
+        stamp: bool = False,
+        observer: Optional[MigrantObserver] = None,
+        keep_going: bool = False,
+        journal: Optional[Journal] = None,
+        resume: bool = False,
+        shard: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        super().__init__(
+            repository,
+            config,
+            dry_run,
+            stamp,
+            observer,
+            keep_going,
+            journal,
+            resume,
+            shard,
+        )
+        self.backend = backend
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        # Semaphores, limiting concurrency of scripts
+        self._script_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _key(self, db: DBN) -> str:
+        return self.backend.database_key(db)
+
+    async def update(self, target_id: Optional[str] = None) -> UpdateReport:
+        """Upgrade or downgrade all databases to revision `target_id`
+
+        Return report with outcome of each database.
+        """
+        target_id = self.pick_rev_id(target_id)
+        conns = self._sharded(self.backend.generate_connections())
+        self._script_semaphores = {
+            revid: asyncio.Semaphore(limit)
+            for revid, limit in self.script_limits().items()
+        }
+
+        fingerprint = self.fingerprint(target_id)
+        result = UpdateReport()
+
+        async def unjournaled() -> AsyncIterator[DBN]:
+            async for db in self._aqueued(conns):
+                if not self._journaled(db, fingerprint, result):
+                    yield db
+
+        async def update(db: DBN, target_id: str) -> DbResult:
+            # Record to the journal as soon as database is completed
+            dbresult = await self._update(db, target_id)
+            self._record(dbresult, fingerprint)
+            return dbresult
+
+        for dbresult in await self._map(update, unjournaled(), target_id):
+            result.add(dbresult)
+        log.info(result.summary())
+        return result
+
+    async def status(self, target_id: Optional[str] = None) -> int:
+        """Return number of migration actions to be performed to
+        upgrade to target_id"""
+        pending = await self.pending_actions(target_id)
+        return sum(len(actions) for actions in pending.values() if actions)
+
+    async def plan(self, target_id: Optional[str] = None) -> FleetPlan:
+        """Return pending actions of all databases, grouped by databases that
+        need the same actions. Databases are not modified in any way."""
+        plan = FleetPlan(self.pick_rev_id(target_id))
+        for db, actions in (await self.pending_actions(target_id)).items():
+            plan.add(db, actions)
+        return plan
+
+    async def pending_actions(
+        self, target_id: Optional[str] = None
+    ) -> Dict[str, Optional[Actions]]:
+        """Return actions to be performed to upgrade each database to target_id
+
+        Result is keyed by database key. Unavailable databases have `None`
+        instead of actions. Databases are not modified in any way.
+        """
+        target_id = self.pick_rev_id(target_id)
+        conns = self._sharded(self.backend.generate_connections())
+        return dict(await self._map(self._inspect, conns, target_id))
+
+    async def _sharded(
+        self, conns: Union[Iterable[DBN], AsyncIterable[DBN]]
+    ) -> AsyncIterator[DBN]:
+        async for db in _aiter(conns):
+            if self.in_shard(db):
+                yield db
+
+    async def _aqueued(
+        self, conns: Union[Iterable[DBN], AsyncIterable[DBN]]
+    ) -> AsyncIterator[DBN]:
+        async for db in _aiter(conns):
+            self._emit(events.DB_QUEUED, db)
+            yield db
+
+    async def _map(
+        self,
+        func: Callable[..., Awaitable[Any]],
+        conns: Union[Iterable[DBN], AsyncIterable[DBN]],
+        *args: Any,
+    ) -> List[Any]:
+        """Call `func` for each database concurrently and return results
+
+        Connections are consumed lazily, no more than `concurrency` databases
+        are in flight at any time. When processing of any database fails, no
+        new databases are started and the error is raised after in-flight
+        ones are completed.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results: List[Any] = []
+        errors: List[BaseException] = []
+        tasks: Set["asyncio.Future[None]"] = set()
+
+        async def run(conn: DBN) -> None:
+            try:
+                results.append(await func(conn, *args))
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                semaphore.release()
+
+        async for conn in _aiter(conns):
+            await semaphore.acquire()
+            if errors:
+                semaphore.release()
+                break
+            task = asyncio.ensure_future(run(conn))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+        if errors:
+            raise errors[0]
+        return results
+
+    async def _inspect(self, db: DBN, target_id: str) -> Tuple[str, Optional[Actions]]:
+        try:
+            with self._timed_call("begin", db):
+                cdb = await self.backend.begin(db)
+        except exceptions.DatabaseUnavailable:
+            log.warning(f"Database {db} is not available")
+            return self._key(db), None
+
+        try:
+            migrations = await self.list_backend_migrations(cdb)
+            if not migrations:
+                # Database will be initialized as fully up-to-date
+                migrations = self.script_ids
+            actions = self._plan_migrations(cdb, migrations, target_id)
+            return self._key(db), actions
+        finally:
+            await self.backend.cleanup(cdb)
+
+    async def _update(self, db: DBN, target_id: str) -> DbResult:
+        started = time.perf_counter()
+        self._emit(events.DB_STARTED, db)
+        try:
+            await self._migrate(db, target_id)
+        except exceptions.DatabaseUnavailable as e:
+            self._emit(events.DB_SKIPPED, db, error=str(e))
+            return DbResult(self._key(db), report.SKIPPED, str(e))
+        except BaseException as e:
+            duration = time.perf_counter() - started
+            self._emit(events.DB_ABORTED, db, duration=duration, error=repr(e))
+            if not self.keep_going or not isinstance(e, Exception):
+                raise
+            log.exception(f"Migration failed for {db}")
+            return DbResult(self._key(db), report.FAILED, repr(e), duration)
+        duration = time.perf_counter() - started
+        self._emit(events.DB_COMMITTED, db, duration=duration)
+        return DbResult(self._key(db), report.SUCCEEDED, None, duration)
+
+    async def _migrate(self, db: DBN, target_id: str) -> None:
+        cdb = await self.initialized_db(db)
+        log.info(f"Starting migration for {cdb}")
+        try:
+            actions = await self.calc_actions(cdb, target_id)
+            await self.execute_actions(cdb, actions)
+            with self._timed_call("commit", cdb):
+                await self.backend.commit(cdb)
+        except BaseException:
+            await self.backend.abort(cdb)
+            raise
+        finally:
+            await self.backend.cleanup(cdb)
+        log.info(f"Migration completed for {cdb}")
+
+    async def initialized_db(self, db: DBN) -> DBC:
+        log.info(f"Preparing migrations for {db}")
+        try:
+            with self._timed_call("begin", db):
+                cdb = await self.backend.begin(db)
+        except exceptions.DatabaseUnavailable:
+            log.warning(f"Database {db} is not available")
+            raise
+
+        with self._timed_call("list_migrations", cdb):
+            migrations = await self.backend.list_migrations(cdb)
+        if not migrations:
+            await self.initialize_db(cdb)
+
+        return cdb
+
+    async def initialize_db(self, db: DBC) -> None:
+        """Iniitialize database that was never migrated before
+
+        Assume it is fully up-to-date.
+        """
+        names = ["INITIAL"] + self.script_names(self.script_ids[1:])
+        if not self.dry_run:
+            with self._timed_call("push_migrations", db):
+                await self.backend.push_migrations(db, names)
+
+        log.info(
+            f"Initialized migrations for {db}"
+            f"{' (not really)' if self.dry_run else ''}. "
+            f"Assuming database is at {names[-1]}"
+        )
+
+    async def calc_actions(self, db: DBC, target_revid: str) -> Actions:
+        """Caclulate actions, required to update to revision `target_revid`
+        """
+        migrations = await self.list_backend_migrations(db)
+        if not migrations and self.dry_run:
+            # Database is not really initialized in dry run
+            migrations = self.script_ids
+        assert len(migrations) > 0, "Migrations are initialized"
+        return list(self._plan_migrations(db, migrations, target_revid))
+
+    async def list_backend_migrations(self, db: DBC) -> List[str]:
+        with self._timed_call("list_migrations", db):
+            migrations = await self.backend.list_migrations(db)
+        return [canonical_rev_id(revid) for revid in migrations]
+
+    async def execute_actions(self, db: DBC, actions: Actions) -> None:
+        if self.stamp:
+            await self.stamp_actions(db, actions)
+            return
+
+        for action, revid in actions:
+            script = self.repository.load_script(revid)
+            assert action in ("+", "-")
+            log.info(
+                "%s to %s%s",
+                "Upgrading" if action == "+" else "Reverting",
+                script.name,
+                " (not really)" if self.dry_run else "",
+            )
+            if self.dry_run:
+                continue
+
+            semaphore = self._script_semaphores.get(revid)
+            if semaphore is not None:
+                await semaphore.acquire()
+            try:
+                self._emit(events.SCRIPT_STARTED, db, script=script.name, action=action)
+                started = time.perf_counter()
+                if action == "+":
+                    await _maybe_await(script.up(db))
+                else:
+                    await _maybe_await(script.down(db))
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+            if action == "+":
+                await self.backend.push_migration(db, script.name)
+            else:
+                await self.backend.pop_migration(db, script.name)
+            self._emit(
+                events.SCRIPT_FINISHED,
+                db,
+                script=script.name,
+                action=action,
+                duration=time.perf_counter() - started,
+            )
+
+    async def stamp_actions(self, db: DBC, actions: Actions) -> None:
+        """Record actions as performed without executing migration scripts
+        """
+        toremove = self.script_names([revid for a, revid in actions if a == "-"])
+        toadd = self.script_names([revid for a, revid in actions if a == "+"])
+        for name in toremove:
+            log.info(
+                "Stamping %s as reverted%s",
+                name,
+                " (not really)" if self.dry_run else "",
+            )
+        for name in toadd:
+            log.info(
+                "Stamping %s as applied%s",
+                name,
+                " (not really)" if self.dry_run else "",
+            )
+        if self.dry_run:
+            return
+        if toremove:
+            await self.backend.pop_migrations(db, toremove)
+        if toadd:
+            await self.backend.push_migrations(db, toadd)
+
+
+async def _maybe_await(result: Any) -> Any:
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+async def _aiter(conns: Union[Iterable[DBN], AsyncIterable[DBN]]) -> AsyncIterator[DBN]:
+    if isinstance(conns, AsyncIterable):
+        async for conn in conns:
+            yield conn
+    else:
+        for conn in conns:
+            yield conn
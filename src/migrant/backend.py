@@ -3,7 +3,7 @@
 # Copyright 2014 by Shoobx, Inc.
 #
 ###############################################################################
-from typing import List, Iterable, Generic, TypeVar
+from typing import List, Iterable, Generic, TypeVar, Optional
 import logging
 import importlib.metadata
 
@@ -22,11 +22,36 @@ DBC = TypeVar("DBC")
 class MigrantBackend(Generic[DBN, DBC]):
     """Base interface for backend implementations"""
 
+    # Whether backend can be used from several threads at once. Only
+    # thread-safe backends can be used with "thread" executor.
+    thread_safe: bool = False
+
     def generate_connections(self) -> Iterable[DBN]:
         """Generate connections to process
         """
         raise NotImplementedError  # pragma: no cover
 
+    def database_key(self, db: DBN) -> str:
+        """Return key, identifying the database, e.g. its name
+
+        Key identifies database in reports, the journal and the work queue,
+        and assigns it to a shard, so it must be the same in every process
+        and on every host. Default is `str(db)`, that is stable only when
+        database type defines `__str__`. Otherwise, default representation
+        includes memory address, and backend must override this method.
+        """
+        return str(db)
+
+    def count_connections(self) -> Optional[int]:
+        """Return number of connections, `generate_connections` generates
+
+        This is optional and only used to report progress of the upgrade.
+        Connections are generated lazily, so backend should implement it only
+        when count is cheap, e.g. from central catalog. Return `None` if
+        number is not known.
+        """
+        return None
+
     def generate_test_connections(self) -> Iterable[DBN]:
         """Generate connections for migration tests
 
@@ -76,6 +101,72 @@ class MigrantBackend(Generic[DBN, DBC]):
     def pop_migration(self, db: DBC, migration: str) -> None:
         raise NotImplementedError  # pragma: no cover
 
+    def push_migrations(self, db: DBC, migrations: List[str]) -> None:
+        """Record several migrations as applied, in given order
+
+        Default implementation calls `push_migration` for each migration.
+        Backends may override it to record all of them in one go.
+        """
+        for migration in migrations:
+            self.push_migration(db, migration)
+
+    def pop_migrations(self, db: DBC, migrations: List[str]) -> None:
+        """Remove several migrations from applied ones, in given order
+
+        Default implementation calls `pop_migration` for each migration.
+        Backends may override it to remove all of them in one go.
+        """
+        for migration in migrations:
+            self.pop_migration(db, migration)
+
+    def estimate_cost(self, db: DBN) -> float:
+        """Estimate cost of migrating the database, e.g. its size
+
+        Used when databases are scheduled by cost: costlier databases are
+        dispatched first, so that they do not delay completion of the whole
+        run. Backend can return explicit priority here as well.
+        """
+        return 0  # pragma: no cover
+
+    def connection_group(self, db: DBN) -> Optional[str]:
+        """Return name of the group, database belongs to, e.g. its host
+
+        Used to limit number of databases of the same group, migrated at
+        once, so that no single server gets overloaded. Databases without
+        group (`None`) are not limited.
+        """
+        return None  # pragma: no cover
+
+    def read_fingerprint(self, db: DBC) -> Optional[str]:
+        """Read fingerprint, stored with `write_fingerprint`
+
+        This is optional. When stored fingerprint matches fingerprint of the
+        target state, database is considered up-to-date without listing its
+        migrations. Return `None` if there is no fingerprint stored.
+        """
+        return None
+
+    def write_fingerprint(self, db: DBC, fingerprint: str) -> None:
+        """Store fingerprint of the state, database is migrated to
+
+        Called after migration is performed, before commit. Fingerprint is a
+        short string, backend should store it as a single value.
+        """
+        pass
+
+    def bulk_list_migrations(self, dbs: List[DBN]) -> List[Optional[List[str]]]:
+        """List migrations, applied to several databases, in one call
+
+        This is optional. Backend can implement it, when state of many
+        databases can be read cheaply without connecting to each of them,
+        e.g. from central catalog. Engine then connects only to databases,
+        that have pending actions.
+
+        Result is aligned with `dbs`. `None` stands for databases with unknown
+        state, these are processed as usual.
+        """
+        return [None] * len(dbs)  # pragma: no cover
+
     def on_new_script(self, rev_name: str) -> None:
         """Called when new script is created
         """
@@ -88,6 +179,8 @@ class MigrantBackend(Generic[DBN, DBC]):
 
 
 class NoopBackend(MigrantBackend[str, str]):
+    thread_safe = True
+
     def __init__(self, cfg):
         self.cfg = cfg
 
@@ -3,20 +3,29 @@
 # Copyright 2014 by Shoobx, Inc.
 #
 ###############################################################################
-from typing import Dict
+from typing import Dict, Optional, Tuple
 import os
 import sys
 import argparse
+import asyncio
 import logging
+import multiprocessing
 from configparser import ConfigParser
 
 from migrant import exceptions
-from migrant.engine import MigrantEngine
+from migrant.engine import EngineBase, MigrantEngine, EXECUTORS, SCHEDULES
+from migrant.aio import AsyncMigrantBackend, AsyncMigrantEngine
+from migrant.journal import Journal
+from migrant.profiling import ProfileStats, profiled
+from migrant.progress import ProgressReporter
 from migrant.backend import create_backend
 from migrant.repository import create_repo
+from migrant.workqueue import SQLiteWorkQueue
 
 log = logging.getLogger(__name__)
 
+DEFAULT_JOURNAL = "migrant-journal.sqlite"
+
 
 def cmd_init(args, cfg):
     cfg = get_db_config(cfg, args.database)
@@ -34,21 +43,214 @@ def cmd_new(args, cfg):
     backend.on_new_script(revname)
 
 
+def cmd_compile(args, cfg):
+    cfg = get_db_config(cfg, args.database)
+    repo = create_repo(cfg)
+    count = repo.compile()
+    log.info("Compiled %s scripts to %s", count, repo.bundle_fname)
+
+
 def cmd_upgrade(args, cfg: Dict[str, str]) -> None:
     cfg = get_db_config(cfg, args.database)
     repo = create_repo(cfg)
     backend = create_backend(cfg)
+    if args.queue:
+        check_queue_args(args)
+    journal = open_journal(args)
+    progress = None
+    profile = ProfileStats() if args.profile else None
+    if isinstance(backend, AsyncMigrantBackend):
+        check_async_args(args)
+        if args.queue:
+            raise exceptions.ConfigurationError(
+                "Work queue is not supported for asynchronous backends"
+            )
+        aengine = AsyncMigrantEngine(
+            backend,
+            repo,
+            cfg,
+            dry_run=args.dry_run,
+            concurrency=args.parallel,
+            stamp=args.stamp,
+            keep_going=args.keep_going,
+            journal=journal,
+            resume=args.resume,
+            shard=args.shard,
+        )
+        if args.progress:
+            progress = aengine.observer = ProgressReporter(aengine.concurrency)
+        try:
+            if profile:
+                # Event loop runs in this thread only, so it is profiled as
+                # a whole
+                result, data = profiled(asyncio.run, aengine.update(args.revision))
+                profile.add(data)
+            else:
+                result = asyncio.run(aengine.update(args.revision))
+        finally:
+            if progress:
+                progress.finish()
+            if journal:
+                journal.close()
+            if profile:
+                write_profile(profile, args.profile, aengine)
+    else:
+        engine = MigrantEngine(
+            backend,
+            repo,
+            cfg,
+            dry_run=args.dry_run,
+            processes=args.parallel,
+            stamp=args.stamp,
+            executor=args.executor,
+            keep_going=args.keep_going,
+            schedule=args.schedule,
+            group_limit=args.per_group_limit,
+            journal=journal,
+            resume=args.resume,
+            shard=args.shard,
+            profile=profile,
+        )
+        if args.progress:
+            # Only whole fleet can be counted upfront, not a shard or a share
+            # of the work queue
+            total = None
+            if not args.shard and not args.queue:
+                total = backend.count_connections()
+            progress = engine.observer = ProgressReporter(
+                engine.processes, total=total
+            )
+        queue = SQLiteWorkQueue(args.queue) if args.queue else None
+        try:
+            if queue:
+                result = engine.coordinate(queue, args.revision)
+            else:
+                result = engine.update(args.revision)
+        finally:
+            if progress:
+                progress.finish()
+            if journal:
+                journal.close()
+            if queue:
+                queue.close()
+            if profile:
+                write_profile(profile, args.profile, engine)
+
+    if args.report:
+        result.write(args.report)
+    if result.failed:
+        raise exceptions.MigrationFailed(len(result.failed))
+
+
+def write_profile(profile: ProfileStats, fname: str, engine: EngineBase) -> None:
+    profile.dump(fname)
+    for line in profile.summary(engine.script_files()):
+        log.info(line)
+    log.info("Profile is written to %s", fname)
+
+
+def cmd_worker(args, cfg):
+    cfg = get_db_config(cfg, args.database)
+    repo = create_repo(cfg)
+    backend = create_backend(cfg)
+    if isinstance(backend, AsyncMigrantBackend):
+        raise exceptions.ConfigurationError(
+            "Work queue is not supported for asynchronous backends"
+        )
     engine = MigrantEngine(
-        backend, repo, cfg, dry_run=args.dry_run, processes=args.parallel,
+        backend,
+        repo,
+        cfg,
+        processes=args.parallel,
+        executor=args.executor,
+        keep_going=args.keep_going,
+        group_limit=args.per_group_limit,
+    )
+    queue = SQLiteWorkQueue(args.queue)
+    try:
+        result = engine.work(queue)
+    finally:
+        queue.close()
+    if result.failed:
+        raise exceptions.MigrationFailed(len(result.failed))
+
+
+def check_queue_args(args) -> None:
+    """Reject options, that workers of the work queue would not honour"""
+    ignored = [
+        option
+        for option, given in [
+            ("--dry-run", args.dry_run),
+            ("--stamp", args.stamp),
+            ("--schedule", args.schedule != "fifo"),
+            ("--journal", args.journal),
+            ("--resume", args.resume),
+        ]
+        if given
+    ]
+    if ignored:
+        raise exceptions.ConfigurationError(
+            f"{', '.join(ignored)} can not be used with --queue"
+        )
+
+
+def parallel_processes(args) -> int:
+    """Return number of processes for commands, that inspect or test
+    databases
+
+    Engine runs these serially, unless number of processes is given, so
+    `-j` without a number stands for all CPUs here.
+    """
+    return args.parallel or multiprocessing.cpu_count()
+
+
+def check_async_args(args) -> None:
+    """Reject options, that asynchronous engine does not honour"""
+    ignored = [
+        option
+        for option, given in [
+            ("--executor", args.executor != "process"),
+            ("--per-group-limit", args.per_group_limit is not None),
+            ("--schedule", getattr(args, "schedule", "fifo") != "fifo"),
+        ]
+        if given
+    ]
+    if ignored:
+        raise exceptions.ConfigurationError(
+            f"{', '.join(ignored)} can not be used with asynchronous backend"
+        )
+
+
+def open_journal(args) -> Optional[Journal]:
+    """Open journal of completed databases, if requested
+
+    Unless given explicitly, journal is kept next to the config file.
+    """
+    if not args.journal and not args.resume:
+        return None
+    fname = args.journal or os.path.join(
+        os.path.dirname(os.path.abspath(args.config)), DEFAULT_JOURNAL
     )
-    engine.update(args.revision)
+    return Journal(fname, scope=args.database)
 
 
 def cmd_test(args, cfg):
     cfg = get_db_config(cfg, args.database)
     repo = create_repo(cfg)
     backend = create_backend(cfg)
-    engine = MigrantEngine(backend, repo, cfg)
+    if isinstance(backend, AsyncMigrantBackend):
+        raise exceptions.ConfigurationError(
+            "Testing is not supported for asynchronous backends"
+        )
+    engine = MigrantEngine(
+        backend,
+        repo,
+        cfg,
+        processes=parallel_processes(args),
+        executor=args.executor,
+        group_limit=args.per_group_limit,
+        shard=args.shard,
+    )
     engine.test(args.revision)
 
 
@@ -56,14 +258,125 @@ def cmd_status(args, cfg):
     cfg = get_db_config(cfg, args.database)
     repo = create_repo(cfg)
     backend = create_backend(cfg)
-    engine = MigrantEngine(backend, repo, cfg)
-    actions = engine.status()
+    if isinstance(backend, AsyncMigrantBackend):
+        check_async_args(args)
+        aengine = AsyncMigrantEngine(
+            backend, repo, cfg, concurrency=args.parallel, shard=args.shard
+        )
+        pending = asyncio.run(aengine.pending_actions(args.revision))
+    else:
+        engine = MigrantEngine(
+            backend,
+            repo,
+            cfg,
+            processes=parallel_processes(args),
+            executor=args.executor,
+            group_limit=args.per_group_limit,
+            shard=args.shard,
+        )
+        pending = engine.pending_actions(args.revision)
+    actions = sum(len(a) for a in pending.values() if a)
     if actions:
+        outdated = sum(1 for a in pending.values() if a)
         log.info("Pending actions: %s", actions)
+        log.info("Databases to migrate: %s of %s", outdated, len(pending))
     else:
         log.info("Up-to-date")
 
 
+def parse_shard(value: str) -> Tuple[int, int]:
+    try:
+        k, n = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected K/N, got {value}")
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f"shard {k} is out of 1..{n}")
+    return k, n
+
+
+def parse_limit(value: str) -> int:
+    try:
+        limit = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected number, got {value}")
+    if limit < 1:
+        raise argparse.ArgumentTypeError(f"limit must be at least 1, got {limit}")
+    return limit
+
+
+def cmd_plan(args, cfg):
+    cfg = get_db_config(cfg, args.database)
+    repo = create_repo(cfg)
+    backend = create_backend(cfg)
+    if isinstance(backend, AsyncMigrantBackend):
+        check_async_args(args)
+        aengine = AsyncMigrantEngine(
+            backend, repo, cfg, concurrency=args.parallel, shard=args.shard
+        )
+        plan = asyncio.run(aengine.plan(args.revision))
+    else:
+        engine = MigrantEngine(
+            backend,
+            repo,
+            cfg,
+            processes=parallel_processes(args),
+            executor=args.executor,
+            group_limit=args.per_group_limit,
+            shard=args.shard,
+        )
+        plan = engine.plan(args.revision)
+    plan.write(args.output, args.format)
+
+
+def add_parallel_argument(cmd_parser):
+    cmd_parser.add_argument(
+        "-j",
+        "--parallel",
+        nargs="?",
+        type=int,
+        default=1,
+        help=(
+            "Process databases in parallel. If backend provides multiple "
+            "databases, each of them will be processed in parallel. "
+            "Concurrency level is set by this argument. For asynchronous "
+            "backends this is number of databases, processed concurrently."
+        ),
+    )
+    cmd_parser.add_argument(
+        "--executor",
+        choices=EXECUTORS,
+        default="process",
+        help=(
+            "Run parallel work in worker processes (default) or in threads of "
+            "single process. Threads suit backends, that spend most of the "
+            "time waiting for database, but backend must be thread-safe."
+        ),
+    )
+    cmd_parser.add_argument(
+        "--per-group-limit",
+        type=parse_limit,
+        metavar="N",
+        help=(
+            "Process at most N databases of the same connection group (e.g. "
+            "database host, as reported by backend) at once. Other groups "
+            "keep workers busy meanwhile."
+        ),
+    )
+
+
+def add_shard_argument(cmd_parser):
+    cmd_parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="K/N",
+        help=(
+            "Process only K-th of N shards of databases, e.g. 2/4. Databases "
+            "are assigned to shards by stable hash of their names, so fleet "
+            "can be split across N hosts without coordination."
+        ),
+    )
+
+
 parser = argparse.ArgumentParser(description="Database Migration Engine")
 parser.add_argument("database", help="Database name")
 
@@ -87,9 +400,53 @@ new_parser.set_defaults(cmd=cmd_new)
 # new_parser.add_argument("database", help="Database name")
 new_parser.add_argument("title", help="Migration script title")
 
+# COMPILE options
+compile_parser = commands.add_parser(
+    "compile",
+    help=(
+        "Compile migration scripts to a bundle, that is loaded instead of "
+        "script sources. Changed scripts are still loaded from sources."
+    ),
+)
+compile_parser.set_defaults(cmd=cmd_compile)
+
 # STATUS options
 status_parser = commands.add_parser("status", help="Show the migration status")
 status_parser.set_defaults(cmd=cmd_status)
+status_parser.add_argument(
+    "-r",
+    "--revision",
+    help=("Revision to upgrade to. If not specified, " "latest revision will be used"),
+)
+add_parallel_argument(status_parser)
+add_shard_argument(status_parser)
+
+# PLAN options
+plan_parser = commands.add_parser(
+    "plan",
+    help=(
+        "Show pending actions of all databases, grouped by databases that "
+        "need the same actions. Databases are not modified."
+    ),
+)
+plan_parser.set_defaults(cmd=cmd_plan)
+plan_parser.add_argument(
+    "-r",
+    "--revision",
+    help=("Revision to upgrade to. If not specified, " "latest revision will be used"),
+)
+plan_parser.add_argument(
+    "--format", choices=("text", "json"), default="text", help="Output format"
+)
+plan_parser.add_argument(
+    "-o",
+    "--output",
+    metavar="FILE",
+    default="-",
+    help="Write plan to FILE instead of standard output",
+)
+add_parallel_argument(plan_parser)
+add_shard_argument(plan_parser)
 
 # UPGRADE options
 upgrade_parser = commands.add_parser("upgrade", help="Perform upgrade")
@@ -102,6 +459,14 @@ upgrade_parser.add_argument(
         "dry run: do not execute scripts, only " "show what is going to be executed."
     ),
 )
+upgrade_parser.add_argument(
+    "--stamp",
+    action="store_true",
+    help=(
+        "stamp: record migrations as applied or reverted without executing "
+        "migration scripts."
+    ),
+)
 # upgrade_parser.add_argument("database", help="Database name to upgrade")
 upgrade_parser.add_argument(
     "-r",
@@ -109,18 +474,96 @@ upgrade_parser.add_argument(
     help=("Revision to upgrade to. If not specified, " "latest revision will be used"),
 )
 
+add_parallel_argument(upgrade_parser)
+add_shard_argument(upgrade_parser)
+upgrade_parser.add_argument(
+    "-k",
+    "--keep-going",
+    action="store_true",
+    help=(
+        "Continue with other databases when migration of some database "
+        "fails. Failed databases are reported at the end."
+    ),
+)
+upgrade_parser.add_argument(
+    "--schedule",
+    choices=SCHEDULES,
+    default="fifo",
+    help=(
+        "Order, in which databases are migrated: as provided by backend "
+        "(fifo, default), or costliest first, as estimated by backend (cost)."
+    ),
+)
+upgrade_parser.add_argument(
+    "--progress",
+    action="store_true",
+    help=(
+        "Report progress: number of processed databases, throughput and, "
+        "when backend can count databases, estimated time to completion."
+    ),
+)
+upgrade_parser.add_argument(
+    "--report",
+    metavar="FILE",
+    help=(
+        "Write JSON summary of the upgrade with outcome of each database to "
+        "FILE. Use - for standard output."
+    ),
+)
+upgrade_parser.add_argument(
+    "--journal",
+    metavar="FILE",
+    help=(
+        "Record completed databases to SQLite journal FILE, so that "
+        "interrupted upgrade can be resumed with --resume."
+    ),
+)
+upgrade_parser.add_argument(
+    "--resume",
+    action="store_true",
+    help=(
+        "Skip databases, recorded in the journal as completed for the same "
+        "target revision, without connecting to them. Unless --journal is "
+        f"given, {DEFAULT_JOURNAL} next to the config file is used."
+    ),
+)
+upgrade_parser.add_argument(
+    "--queue",
+    metavar="FILE",
+    help=(
+        "Publish databases to SQLite work queue FILE, e.g. on storage shared "
+        "by several hosts, and migrate them together with workers, started "
+        "on these hosts with worker command."
+    ),
+)
 upgrade_parser.add_argument(
-    "-j",
-    "--parallel",
-    nargs="?",
-    type=int,
-    default=1,
+    "--profile",
+    metavar="FILE",
+    help=(
+        "Profile migration of each database, in worker processes too, and "
+        "write merged profile to FILE, that can be read with pstats. Summary "
+        "of the slowest functions and time per migration script is logged."
+    ),
+)
+
+# WORKER options
+worker_parser = commands.add_parser(
+    "worker", help="Migrate databases from the work queue, published by upgrade"
+)
+worker_parser.set_defaults(cmd=cmd_worker)
+worker_parser.add_argument(
+    "--queue", metavar="FILE", required=True, help="SQLite work queue file"
+)
+worker_parser.add_argument(
+    "-k",
+    "--keep-going",
+    action="store_true",
     help=(
-        "Migrate databases in parallel. If backend provides multiple databases, "
-        "migration for each of them will be performed in parallel. Concurrency "
-        "level is set by this argument."
+        "Continue with other databases when migration of some database "
+        "fails. Failures are recorded to the work queue either way."
     ),
 )
+add_parallel_argument(worker_parser)
 
 
 # TEST options
@@ -133,6 +576,8 @@ test_parser.add_argument(
     "--revision",
     help=("Revision to upgrade to. If not specified, " "latest revision will be used"),
 )
+add_parallel_argument(test_parser)
+add_shard_argument(test_parser)
 
 
 def load_config(fname):
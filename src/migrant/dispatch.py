@@ -0,0 +1,149 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+from typing import Any, Callable, Deque, Dict, FrozenSet, Hashable, Iterable
+from typing import Iterator, Optional, Tuple
+import collections
+import queue
+
+from multiprocessing.pool import Pool
+
+
+def imap_bounded(
+    pool: Pool,
+    func: Callable[[Any], Any],
+    items: Iterable[Any],
+    window: int,
+    group_of: Optional[Callable[[Any], Optional[Hashable]]] = None,
+    group_limit: Optional[int] = None,
+) -> Iterator[Any]:
+    """Apply `func` to items in the pool and yield results as they complete
+
+    Unlike `Pool.imap_unordered`, items are consumed lazily: at most `window`
+    items are dispatched to the pool at once, and next item is taken only
+    when some of them completes. Memory use thus does not depend on number of
+    items.
+
+    When `group_limit` is given, no more than `group_limit` dispatched items
+    belong to the same group, as returned by `group_of`. Items of groups, that
+    are at the limit, wait while items of other groups keep the pool busy.
+    At most `window` items wait this way, after that no more items are taken
+    until some group frees up. Items without group (`None`) are not limited.
+    Otherwise, items are dispatched in the order they come.
+    """
+    done: "queue.Queue[Tuple[Optional[Hashable], bool, Any]]" = queue.Queue()
+    running: Dict[Optional[Hashable], int] = collections.Counter()
+    # Items, waiting for their group to free up, with their sequence numbers
+    waiting: Dict[Optional[Hashable], Deque[Tuple[int, Any]]] = {}
+    source = enumerate(items)
+    inflight = 0
+    nwaiting = 0
+
+    def allowed(group: Optional[Hashable]) -> bool:
+        return group is None or group_limit is None or running[group] < group_limit
+
+    def next_item() -> Optional[Tuple[Optional[Hashable], Any]]:
+        nonlocal nwaiting
+        # Earliest waiting item of a group, that is not at the limit
+        ready = [g for g, q in waiting.items() if q and allowed(g)]
+        if ready:
+            group = min(ready, key=lambda g: waiting[g][0][0])
+            nwaiting -= 1
+            return group, waiting[group].popleft()[1]
+
+        while nwaiting < window:
+            try:
+                seq, item = next(source)
+            except StopIteration:
+                return None
+            group = group_of(item) if group_limit and group_of else None
+            if allowed(group):
+                return group, item
+            waiting.setdefault(group, collections.deque()).append((seq, item))
+            nwaiting += 1
+        return None
+
+    def submit(group: Optional[Hashable], item: Any) -> None:
+        running[group] += 1
+        pool.apply_async(
+            func,
+            (item,),
+            callback=lambda result: done.put((group, True, result)),
+            error_callback=lambda error: done.put((group, False, error)),
+        )
+
+    while True:
+        while inflight < window:
+            nxt = next_item()
+            if nxt is None:
+                break
+            submit(*nxt)
+            inflight += 1
+
+        if not inflight:
+            return
+
+        group, ok, value = done.get()
+        inflight -= 1
+        running[group] -= 1
+        if not ok:
+            raise value
+        yield value
+
+
+def imap_pulled(
+    pool: Pool,
+    func: Callable[[Any], Any],
+    pull: Callable[[FrozenSet[Hashable]], Optional[Tuple[Optional[Hashable], Any]]],
+    window: int,
+    group_limit: Optional[int] = None,
+) -> Iterator[Any]:
+    """Apply `func` to items, pulled as pool frees up, and yield results as
+    they complete
+
+    Unlike `imap_bounded`, no item is held back: next item is pulled only
+    when less than `window` items are dispatched, and `pull` is given groups,
+    that are at `group_limit`. It returns next item of other group with the
+    group of the item, or `None`, when there is nothing to process at the
+    moment. Pulling is retried whenever some item completes. Items without
+    group (`None`) are not limited.
+    """
+    done: "queue.Queue[Tuple[Optional[Hashable], bool, Any]]" = queue.Queue()
+    running: Dict[Optional[Hashable], int] = collections.Counter()
+    inflight = 0
+
+    def full() -> FrozenSet[Hashable]:
+        if group_limit is None:
+            return frozenset()
+        return frozenset(
+            g for g, n in running.items() if g is not None and n >= group_limit
+        )
+
+    def submit(group: Optional[Hashable], item: Any) -> None:
+        running[group] += 1
+        pool.apply_async(
+            func,
+            (item,),
+            callback=lambda result: done.put((group, True, result)),
+            error_callback=lambda error: done.put((group, False, error)),
+        )
+
+    while True:
+        while inflight < window:
+            nxt = pull(full())
+            if nxt is None:
+                break
+            submit(*nxt)
+            inflight += 1
+
+        if not inflight:
+            return
+
+        group, ok, value = done.get()
+        inflight -= 1
+        running[group] -= 1
+        if not ok:
+            raise value
+        yield value
@@ -3,97 +3,804 @@
 # Copyright 2014 by Shoobx, Inc.
 #
 ###############################################################################
-from typing import Optional, TypeVar, Dict, List, Tuple, Generic
+from typing import Optional, TypeVar, Dict, List, Tuple, Generic, FrozenSet, Any
+from typing import Iterator, Iterable, Callable, ContextManager
+import os
+import time
+import socket
+import hashlib
+import inspect
 import logging
+import threading
 import multiprocessing
+import multiprocessing.pool
 import functools
+import itertools
+import contextlib
 
-from migrant import exceptions
+from migrant import dispatch, exceptions, events, profiling, report
 from migrant.backend import MigrantBackend
+from migrant.events import MigrantObserver, EventBuffer, Event
+from migrant.journal import Journal
+from migrant.profiling import ProfileStats
+from migrant.report import DbResult, FleetPlan, UpdateReport
 from migrant.repository import Repository
+from migrant.workqueue import WorkQueue
 
 
 log = logging.getLogger(__name__)
 
 Actions = List[Tuple[str, str]]
 
+EXECUTORS = ("process", "thread")
+
+# Order, in which databases are dispatched: as generated by backend, or
+# costliest first
+SCHEDULES = ("fifo", "cost")
+
+# Default number of databases per worker, dispatched to the pool at once
+WINDOW_FACTOR = 2
+
+# Seconds, work queue leases are taken for. Leases are extended while
+# databases are processed.
+LEASE_DURATION = 60.0
+
+# Seconds between polls of the work queue for expired leases
+POLL_INTERVAL = 5.0
+
+# Number of databases to request from `MigrantBackend.bulk_list_migrations`
+# at once
+PREFETCH_BATCH = 1000
+
 DBN = TypeVar("DBN")
 DBC = TypeVar("DBC")
 
+# Pool of workers with function, dispatched to it
+Executor = Tuple[multiprocessing.pool.Pool, Callable[[Any], Any]]
+
+
+class EngineBase:
+    """Backend independent part of migration engines
+
+    Plans migrations and reports events to the observer.
+    """
 
-class MigrantEngine(Generic[DBN, DBC]):
     def __init__(
         self,
-        backend: MigrantBackend[DBN, DBC],
         repository: Repository,
         config: Dict[str, str],
         dry_run: bool = False,
-        processes: Optional[int] = None,
+        stamp: bool = False,
+        observer: Optional[MigrantObserver] = None,
+        keep_going: bool = False,
+        journal: Optional[Journal] = None,
+        resume: bool = False,
+        shard: Optional[Tuple[int, int]] = None,
     ) -> None:
-        self.backend = backend
+        if shard is not None and not 1 <= shard[0] <= shard[1]:
+            raise exceptions.ConfigurationError(f"Invalid shard: {shard[0]}/{shard[1]}")
         self.repository = repository
         self.script_ids = ["INITIAL"] + repository.list_script_ids()
+        self.script_idx = {v: idx for idx, v in enumerate(self.script_ids)}
+        # Plans, calculated so far, keyed by set of applied migrations and
+        # target revision. Most databases share the same state, so the plan
+        # is calculated only once for each of these states.
+        self._plans: Dict[Tuple[FrozenSet[str], str], Actions] = {}
+        self._fingerprints: Dict[str, str] = {}
         self.dry_run = dry_run
+        self.stamp = stamp
+        # Record failures and continue with other databases instead of
+        # stopping the whole update
+        self.keep_going = keep_going
         self.config = config
+        self.observer = observer
+        # Completed databases are recorded to the journal, and with `resume`
+        # databases, recorded before, are skipped without connecting to them
+        self.journal = journal
+        self.resume = resume
+        # Process only K-th of N shards (1-based) of databases
+        self.shard = shard
+        # Serializes observer notifications from worker threads
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Observer lives in the parent process only. When there is one,
+        # workers collect events to buffer, that is forwarded to it.
+        state = self.__dict__.copy()
+        state["observer"] = EventBuffer() if self.observer is not None else None
+        state["journal"] = None
+        if state.get("profile") is not None:
+            # Workers profile their tasks, profiles are merged in the parent
+            state["profile"] = ProfileStats()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def pick_rev_id(self, rev_id: Optional[str] = None) -> str:
+        if rev_id is None:
+            # Pick latest one
+            rev_id = self.script_ids[-1]
+
+        if canonical_rev_id(rev_id) not in self.script_idx:
+            raise exceptions.ScriptNotFoundError(rev_id)
+
+        return rev_id
+
+    def _plan_migrations(
+        self, db: Any, migrations: List[str], target_revid: str
+    ) -> Actions:
+        target_revid = canonical_rev_id(target_revid)
+        assert target_revid in self.script_idx
+
+        applied = frozenset(m for m in migrations if m in self.script_idx)
+        if not applied:
+            log.warning(
+                "No common revision between repository and "
+                "database %s. Running all migrations up to %s",
+                db,
+                target_revid,
+            )
+
+        return self.plan_actions(applied, target_revid)
+
+    def plan_actions(self, applied: FrozenSet[str], target_revid: str) -> Actions:
+        """Calculate actions to update database with `applied` migrations to
+        revision `target_revid`.
+
+        `applied` should contain only canonical ids of migrations, known to
+        the repository. Plans are cached, so do not modify returned list.
+        """
+        key = (applied, target_revid)
+        plan = self._plans.get(key)
+        if plan is not None:
+            return plan
+
+        script_idx = self.script_idx
+        migrations = sorted(applied, key=script_idx.__getitem__)
+        base_revid = migrations[0] if migrations else "INITIAL"
+
+        base_idx = script_idx[base_revid]
+        target_idx = script_idx[target_revid]
+
+        toremove = [m for m in reversed(migrations) if script_idx[m] > target_idx]
+        toadd = [
+            s
+            for s in self.script_ids[base_idx + 1 : target_idx + 1]
+            if s not in applied
+        ]
+        plan = [("-", rid) for rid in toremove] + [("+", rid) for rid in toadd]
+        self._plans[key] = plan
+        return plan
+
+    def revert_actions(self, actions: Actions) -> Actions:
+        reverts = [("+" if a == "-" else "-", script) for a, script in actions]
+        return list(reversed(reverts))
+
+    def _emit(self, kind: str, db: Any, **kwargs: Any) -> None:
+        if self.observer is None:
+            return
+        event = Event(kind, str(db), _pname(), time.time(), **kwargs)
+        with self._lock:
+            self.observer.notify(event)
+
+    def _forward(self, worker_events: List[Event]) -> None:
+        """Deliver events, collected in pool worker, to the observer"""
+        if self.observer is None:
+            return
+        with self._lock:
+            for event in worker_events:
+                self.observer.notify(event)
+
+    @contextlib.contextmanager
+    def _timed_call(self, call: str, db: Any) -> Iterator[None]:
+        """Report duration of backend call to the observer"""
+        if self.observer is None:
+            yield
+            return
+        started = time.perf_counter()
+        yield
+        self._emit(
+            events.BACKEND_CALL, db, call=call, duration=time.perf_counter() - started
+        )
+
+    def _key(self, db: Any) -> str:
+        """Return key, identifying the database across processes and hosts"""
+        return str(db)
+
+    def in_shard(self, db: Any) -> bool:
+        """Check whether database belongs to the configured shard
+
+        Databases are assigned to shards by stable hash of their keys (see
+        `MigrantBackend.database_key`), so every host, given the same N,
+        splits the fleet the same way.
+        """
+        if self.shard is None:
+            return True
+        k, n = self.shard
+        digest = hashlib.sha1(self._key(db).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") % n == k - 1
+
+    def _journaled(self, db: Any, fingerprint: str, result: UpdateReport) -> bool:
+        """Check whether database is completed according to the journal
+
+        Journaled database is reported as skipped.
+        """
+        if not self.resume or self.journal is None:
+            return False
+        if not self.journal.is_completed(fingerprint, self._key(db)):
+            return False
+        self._emit(events.DB_SKIPPED, db, error="journaled")
+        result.add(DbResult(self._key(db), report.SKIPPED, "journaled"))
+        return True
+
+    def _record(self, dbresult: DbResult, fingerprint: str) -> None:
+        """Record migrated or up-to-date database to the journal"""
+        if self.journal is None or self.dry_run:
+            return
+        if dbresult.status == report.SUCCEEDED or dbresult.error == "up-to-date":
+            self.journal.record(fingerprint, dbresult.db)
+
+    def fingerprint(self, target_revid: str) -> str:
+        """Return fingerprint of repository state up to `target_revid`
+
+        Fingerprint identifies ordered list of scripts, that database,
+        migrated to `target_revid`, has seen. It changes whenever any script
+        is added to or removed from that part of repository.
+        """
+        fingerprint = self._fingerprints.get(target_revid)
+        if fingerprint is None:
+            target_idx = self.script_idx[canonical_rev_id(target_revid)]
+            scripts = "\n".join(self.script_ids[: target_idx + 1])
+            fingerprint = hashlib.sha1(scripts.encode("utf-8")).hexdigest()
+            self._fingerprints[target_revid] = fingerprint
+        return fingerprint
+
+    def script_limits(self) -> Dict[str, int]:
+        """Return concurrency limits, declared by migration scripts
+
+        Scripts limit number of databases they migrate at once with
+        `max_concurrency` module attribute. Literal limits are read without
+        executing scripts.
+        """
+        limits = {}
+        for revid in self.script_ids[1:]:
+            script = self.repository.load_script(revid)
+            limit = getattr(script, "max_concurrency", None)
+            if limit:
+                limits[revid] = limit
+        return limits
+
+    def script_files(self) -> Dict[str, str]:
+        """Map file names of migration scripts to script names"""
+        files = {}
+        for revid in self.script_ids[1:]:
+            script = self.repository.load_script(revid)
+            filename = getattr(script, "filename", None)
+            if filename:
+                files[filename] = script.name
+        return files
+
+    def script_names(self, revids: List[str]) -> List[str]:
+        """Resolve revision ids into proper script names"""
+        return [self.repository.script_name(revid) for revid in revids]
+
+
+class MigrantEngine(EngineBase, Generic[DBN, DBC]):
+    def __init__(
+        self,
+        backend: MigrantBackend[DBN, DBC],
+        repository: Repository,
+        config: Dict[str, str],
+        dry_run: bool = False,
+        processes: Optional[int] = None,
+        stamp: bool = False,
+        observer: Optional[MigrantObserver] = None,
+        executor: str = "process",
+        keep_going: bool = False,
+        schedule: str = "fifo",
+        group_limit: Optional[int] = None,
+        window: Optional[int] = None,
+        journal: Optional[Journal] = None,
+        resume: bool = False,
+        shard: Optional[Tuple[int, int]] = None,
+        profile: Optional[ProfileStats] = None,
+    ) -> None:
+        if executor not in EXECUTORS:
+            raise exceptions.ConfigurationError(f"Unknown executor: {executor}")
+        if schedule not in SCHEDULES:
+            raise exceptions.ConfigurationError(f"Unknown schedule: {schedule}")
+        if executor == "thread" and not backend.thread_safe:
+            raise exceptions.ConfigurationError(
+                f"Backend {type(backend).__name__} is not thread-safe, "
+                "use process executor instead"
+            )
+        if group_limit is not None and group_limit < 1:
+            raise exceptions.ConfigurationError(
+                f"Invalid per-group limit: {group_limit}"
+            )
+        if executor == "thread" and profile is not None:
+            raise exceptions.ConfigurationError(
+                "Profiling is not supported with thread executor"
+            )
+        super().__init__(
+            repository,
+            config,
+            dry_run,
+            stamp,
+            observer,
+            keep_going,
+            journal,
+            resume,
+            shard,
+        )
+        self.backend = backend
         self.processes = processes or multiprocessing.cpu_count()
+        # Databases are inspected and tested in parallel only when number of
+        # processes is given explicitly. Otherwise, these run serially, as
+        # they always did, so that backend need not be picklable for them.
+        self._parallel_reads = processes is not None
+        self.executor = executor
+        self.schedule = schedule
+        # Maximum number of databases of the same connection group, processed
+        # at once
+        self.group_limit = group_limit
+        # Maximum number of databases, dispatched to the pool at once.
+        # Connections are taken from backend only as workers free up.
+        self.window = window or self.processes * WINDOW_FACTOR
+        # Each database is processed under profiler, profiles are merged here
+        self.profile = profile
+        # Semaphores, limiting concurrency of scripts across workers
+        self._script_semaphores: Dict[str, Any] = {}
+
+    def _key(self, db: DBN) -> str:
+        return self.backend.database_key(db)
 
     def status(self, target_id: Optional[str] = None) -> int:
         """Return number of migration actions to be performed to
         upgrade to target_id"""
+        pending = self.pending_actions(target_id)
+        return sum(len(actions) for actions in pending.values() if actions)
+
+    def plan(self, target_id: Optional[str] = None) -> FleetPlan:
+        """Return pending actions of all databases, grouped by databases that
+        need the same actions. Databases are not modified in any way."""
+        plan = FleetPlan(self.pick_rev_id(target_id))
+        for db, actions in self.pending_actions(target_id).items():
+            plan.add(db, actions)
+        return plan
+
+    def pending_actions(
+        self, target_id: Optional[str] = None
+    ) -> Dict[str, Optional[Actions]]:
+        """Return actions to be performed to upgrade each database to target_id
+
+        Result is keyed by database key. Unavailable databases have `None`
+        instead of actions. Databases are not modified in any way. They are
+        inspected in parallel only when engine is given number of processes.
+        """
         target_id = self.pick_rev_id(target_id)
-        conns = self.backend.generate_connections()
+        conns = filter(self.in_shard, self.backend.generate_connections())
+
+        known: Dict[str, Optional[Actions]] = {}
+
+        def unknown() -> Iterator[DBN]:
+            for db, actions in self._prefetched(conns, target_id):
+                if actions is None:
+                    yield db
+                else:
+                    known[self._key(db)] = actions
+
+        serial = not self._parallel_reads
+        pending = dict(self._map("_inspect", unknown(), target_id, serial=serial))
+        pending.update(known)
+        return pending
+
+    def _prefetched(
+        self, conns: Iterable[DBN], target_id: str
+    ) -> Iterator[Tuple[DBN, Optional[Actions]]]:
+        """Pair databases with their pending actions, if backend can list
+        migrations in bulk. Actions are `None` for databases with unknown
+        state.
+        """
+        if not _overrides(self.backend, "bulk_list_migrations"):
+            for db in conns:
+                yield db, None
+            return
 
-        total_actions = 0
-        for db in conns:
-            try:
-                cdb = self.initialized_db(db)
-            except exceptions.DatabaseUnavailable:
-                continue
-            actions = self.calc_actions(cdb, target_id)
-            total_actions += len(actions)
+        for batch in _batches(conns, PREFETCH_BATCH):
+            states = self.backend.bulk_list_migrations(batch)
+            for db, migrations in zip(batch, states):
+                if not migrations:
+                    # Unknown or not initialized database
+                    yield db, None
+                    continue
+                canonical = [canonical_rev_id(m) for m in migrations]
+                yield db, self._plan_migrations(db, canonical, target_id)
+
+    def _inspect(self, db: DBN, target_id: str) -> Tuple[str, Optional[Actions]]:
+        try:
+            with self._timed_call("begin", db):
+                cdb = self.backend.begin(db)
+        except exceptions.DatabaseUnavailable:
+            log.warning(f"{_pname()}: Database {db} is not available")
+            return self._key(db), None
 
-        return total_actions
+        try:
+            if self._is_current(cdb, self.fingerprint(target_id)):
+                return self._key(db), []
+            migrations = self.list_backend_migrations(cdb)
+            if not migrations:
+                # Database will be initialized as fully up-to-date
+                migrations = self.script_ids
+            actions = self._plan_migrations(cdb, migrations, target_id)
+            return self._key(db), actions
+        finally:
+            self.backend.cleanup(cdb)
 
-    def _update(self, db: DBN, target_id: str) -> None:
+    def _update(self, db: DBN, target_id: str) -> DbResult:
+        started = time.perf_counter()
+        self._emit(events.DB_STARTED, db)
         try:
-            cdb = self.initialized_db(db)
-        except exceptions.DatabaseUnavailable:
-            return
+            self._migrate(db, target_id)
+        except exceptions.DatabaseUnavailable as e:
+            self._emit(events.DB_SKIPPED, db, error=str(e))
+            return DbResult(self._key(db), report.SKIPPED, str(e))
+        except BaseException as e:
+            duration = time.perf_counter() - started
+            self._emit(events.DB_ABORTED, db, duration=duration, error=repr(e))
+            if not self.keep_going or not isinstance(e, Exception):
+                raise
+            log.exception(f"{_pname()}: Migration failed for {db}")
+            return DbResult(self._key(db), report.FAILED, repr(e), duration)
+        duration = time.perf_counter() - started
+        self._emit(events.DB_COMMITTED, db, duration=duration)
+        return DbResult(self._key(db), report.SUCCEEDED, None, duration)
+
+    def _migrate(self, db: DBN, target_id: str) -> None:
+        cdb = self._connect(db)
         log.info(f"{_pname()}: Starting migration for {cdb}")
-        actions = self.calc_actions(cdb, target_id)
         try:
-            self.execute_actions(cdb, actions)
-            self.backend.commit(cdb)
-        except:
+            fingerprint = self.fingerprint(target_id)
+            if self._is_current(cdb, fingerprint):
+                log.info(f"{_pname()}: Database {cdb} is up-to-date")
+            else:
+                self._ensure_initialized(cdb)
+                actions = self.calc_actions(cdb, target_id)
+                self.execute_actions(cdb, actions)
+                if not self.dry_run:
+                    with self._timed_call("write_fingerprint", cdb):
+                        self.backend.write_fingerprint(cdb, fingerprint)
+            with self._timed_call("commit", cdb):
+                self.backend.commit(cdb)
+        except BaseException:
             self.backend.abort(cdb)
             raise
         finally:
             self.backend.cleanup(cdb)
         log.info(f"{_pname()}: Migration completed for {cdb}")
 
-    def update(self, target_id: Optional[str] = None) -> None:
+    def update(self, target_id: Optional[str] = None) -> UpdateReport:
+        """Upgrade or downgrade all databases to revision `target_id`
+
+        Return report with outcome of each database. Unless engine is
+        configured to keep going, first failure is raised and stops the
+        whole update.
+        """
+        target_id = self.pick_rev_id(target_id)
+        conns = filter(self.in_shard, self.backend.generate_connections())
+        fingerprint = self.fingerprint(target_id)
+
+        result = UpdateReport()
+
+        def unjournaled() -> Iterator[DBN]:
+            for db in self._queued(conns):
+                if not self._journaled(db, fingerprint, result):
+                    yield db
+
+        def outdated() -> Iterator[DBN]:
+            # Do not even connect to databases, known to be up-to-date
+            for db, actions in self._prefetched(unjournaled(), target_id):
+                if actions is not None and not actions:
+                    self._emit(events.DB_SKIPPED, db, error="up-to-date")
+                    dbresult = DbResult(self._key(db), report.SKIPPED, "up-to-date")
+                    result.add(dbresult)
+                    self._record(dbresult, fingerprint)
+                else:
+                    yield db
+
+        for dbresult in self._map("_update", self._scheduled(outdated()), target_id):
+            result.add(dbresult)
+            self._record(dbresult, fingerprint)
+        log.info(result.summary())
+        return result
+
+    def publish(self, queue: WorkQueue, target_id: Optional[str] = None) -> int:
+        """Publish databases to migrate to `target_id` to the work queue
+
+        Return number of published databases.
+        """
+        self._check_queue_mode()
+        target_id = self.pick_rev_id(target_id)
+        conns = filter(self.in_shard, self.backend.generate_connections())
+        fingerprint = self.fingerprint(target_id)
+        dbs = self._queued(conns)
+        group_of = self.backend.connection_group
+        count = queue.publish(target_id, fingerprint, dbs, group_of, self._key)
+        log.info(f"Published {count} databases to the work queue")
+        return count
+
+    def work(
+        self,
+        queue: WorkQueue,
+        worker: Optional[str] = None,
+        lease: float = LEASE_DURATION,
+        poll: float = POLL_INTERVAL,
+    ) -> UpdateReport:
+        """Migrate databases from the work queue, until it is drained
+
+        Databases are leased from the queue only when some worker of this
+        engine is free, and their leases are extended in background while
+        they are processed. With per-group limit, databases of groups, that
+        are at the limit, are left for other hosts. When nothing is left to
+        lease, but other workers still hold some leases, queue is polled
+        every `poll` seconds, as these leases may expire.
+
+        Return report with outcome of databases, processed by this worker.
+        Unless engine is configured to keep going, first failure stops the
+        worker. Failure is recorded to the queue either way. When queue is
+        republished for different set of scripts meanwhile, worker stops
+        with `ConfigurationError`.
+        """
+        self._check_queue_mode()
+        target_id, fingerprint = queue.target()
         target_id = self.pick_rev_id(target_id)
-        conns = self.backend.generate_connections()
+        if self.fingerprint(target_id) != fingerprint:
+            raise exceptions.ConfigurationError(
+                "Work queue is published for different set of scripts"
+            )
+        worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+
+        def leased() -> Iterator[DBN]:
+            while True:
+                task = queue.lease(worker, lease, fingerprint)
+                if task is None:
+                    return
+                yield task.db
+
+        def pull(full: FrozenSet[Any]) -> Optional[Tuple[Optional[str], DBN]]:
+            task = queue.lease(worker, lease, fingerprint, full)
+            if task is None:
+                return None
+            return task.group, task.db
+
+        stop = threading.Event()
+
+        def heartbeat() -> None:
+            while not stop.wait(lease / 3):
+                queue.heartbeat(worker, lease)
+
+        def processed(executor: Optional[Executor]) -> Iterator[DbResult]:
+            if executor is None:
+                for db in leased():
+                    yield self._call("_work", db, target_id)
+                return
+            pool, func = executor
+            results = dispatch.imap_pulled(
+                pool, func, pull, self.processes, self.group_limit
+            )
+            yield from self._collect(results)
+
+        result = UpdateReport()
+        beating = threading.Thread(target=heartbeat, daemon=True)
+        beating.start()
+        try:
+            # Pool is kept while queue is polled for expired leases
+            with self._executor("_work", target_id) as executor:
+                while True:
+                    for dbresult in processed(executor):
+                        queue.complete(dbresult)
+                        result.add(dbresult)
+                        if dbresult.status == report.FAILED and not self.keep_going:
+                            log.error(
+                                f"Migration failed for {dbresult.db}: "
+                                f"{dbresult.error}"
+                            )
+                            raise exceptions.MigrationFailed(1)
+                    if not queue.remaining():
+                        break
+                    time.sleep(poll)
+        finally:
+            stop.set()
+            beating.join()
+        log.info(result.summary())
+        return result
+
+    def _check_queue_mode(self) -> None:
+        # Queue carries only the target, so every worker migrates databases
+        # for real, in order they were published. Completed databases are
+        # recorded to the queue, not to the journal.
+        if self.dry_run or self.stamp:
+            raise exceptions.ConfigurationError(
+                "Dry run and stamping are not supported with work queue"
+            )
+        if self.schedule != "fifo":
+            raise exceptions.ConfigurationError(
+                "Work queue dispatches databases in order they were published"
+            )
+        if self.journal is not None or self.resume:
+            raise exceptions.ConfigurationError(
+                "Journal is not supported with work queue, queue records "
+                "completed databases itself"
+            )
 
-        f = functools.partial(self._update, target_id=target_id)
+    def _work(self, db: DBN, target_id: str) -> DbResult:
+        # Failure is reported as a result, so that it can be recorded to the
+        # work queue. Otherwise lease would expire and database would be
+        # retried over and over.
+        try:
+            return self._update(db, target_id)
+        except Exception as e:
+            return DbResult(self._key(db), report.FAILED, repr(e))
 
-        if self.processes == 1:
+    def coordinate(
+        self, queue: WorkQueue, target_id: Optional[str] = None
+    ) -> UpdateReport:
+        """Publish databases to the work queue and work on them
+
+        Other workers (see `work`) may join at any time. Return report with
+        outcome of all published databases.
+        """
+        self.publish(queue, target_id)
+        self.work(queue)
+        result = queue.report()
+        log.info(result.summary())
+        return result
+
+    def _queued(self, conns: Iterable[DBN]) -> Iterator[DBN]:
+        for db in conns:
+            self._emit(events.DB_QUEUED, db)
+            yield db
+
+    def _scheduled(self, conns: Iterable[DBN]) -> Iterable[DBN]:
+        """Order databases according to configured schedule
+
+        Scheduling by cost (longest processing time first) keeps all workers
+        busy till the end of the run. It requires all databases to be
+        generated before the first one is dispatched.
+        """
+        if self.schedule == "fifo":
+            return conns
+
+        costed = [
+            (self.backend.estimate_cost(db), idx, db) for idx, db in enumerate(conns)
+        ]
+        costed.sort(key=lambda c: (-c[0], c[1]))
+        return [db for _, _, db in costed]
+
+    def _map(
+        self, method: str, conns: Iterable[DBN], *args: Any, serial: bool = False
+    ) -> Iterator[Any]:
+        """Call engine method for each database and yield results
+
+        Databases are processed in pool of worker processes or threads,
+        unless engine is configured to use single process, or `serial`
+        processing is requested. Connections are consumed lazily, no more
+        than `window` of them are dispatched at once.
+        """
+        if serial:
             for conn in conns:
-                f(conn)
-        else:
-            with multiprocessing.Pool(self.processes) as pool:
-                for _ in pool.imap_unordered(f, conns):
-                    pass
+                yield self._call(method, conn, *args)
+            return
+
+        with self._executor(method, *args) as executor:
+            if executor is None:
+                for conn in conns:
+                    yield self._call(method, conn, *args)
+                return
+
+            pool, func = executor
+            results = dispatch.imap_bounded(
+                pool,
+                func,
+                conns,
+                self.window,
+                self.backend.connection_group,
+                self.group_limit,
+            )
+            yield from self._collect(results)
+
+    @contextlib.contextmanager
+    def _executor(self, method: str, *args: Any) -> Iterator[Optional[Executor]]:
+        """Start pool of workers, that call engine method for databases
+
+        Yield the pool with function to dispatch to it, or `None` when engine
+        is configured to use single process. Results of the function are
+        delivered with `_collect`.
+        """
+        if self.processes == 1:
+            yield None
+            return
 
-    def test(self, target_id: Optional[str] = None) -> None:
+        semaphore_factory: Callable[[int], Any]
+        if self.executor == "thread":
+            semaphore_factory = threading.BoundedSemaphore
+        else:
+            semaphore_factory = multiprocessing.BoundedSemaphore
+        self._script_semaphores = {
+            revid: semaphore_factory(limit)
+            for revid, limit in self.script_limits().items()
+        }
+
+        pool: multiprocessing.pool.Pool
+        func: Callable[[DBN], Tuple[Any, List[Event], Optional[Dict[Any, Any]]]]
+        if self.executor == "thread":
+            # Threads share the engine, events are delivered directly
+            method_func = getattr(self, method)
+            pool = multiprocessing.pool.ThreadPool(self.processes)
+            func = lambda conn: (method_func(conn, *args), [], None)  # noqa: E731
+        else:
+            # Engine is shipped to each worker once, tasks carry only databases
+            pool = multiprocessing.Pool(
+                self.processes, initializer=_init_worker, initargs=(self,)
+            )
+            func = functools.partial(_pool_call, method, args)
+
+        with pool:
+            yield pool, func
+
+    def _call(self, method: str, conn: DBN, *args: Any) -> Any:
+        """Call engine method for database in this process"""
+        if self.profile is None:
+            return getattr(self, method)(conn, *args)
+        result, data = profiling.profiled(getattr(self, method), conn, *args)
+        self.profile.add(data)
+        return result
+
+    def _collect(self, results: Iterable[Any]) -> Iterator[Any]:
+        """Yield results of pool workers, delivering their events and
+        profiles"""
+        for result, worker_events, profile_data in results:
+            self._forward(worker_events)
+            if self.profile is not None and profile_data is not None:
+                self.profile.add(profile_data)
+            yield result
+
+    def test(self, target_id: Optional[str] = None) -> Dict[str, Optional[str]]:
+        """Test pending migrations on test databases
+
+        Return test results, keyed by database key: `None` for passed
+        databases, and error description for failed ones. Raises
+        `MigrationTestFailed` after all databases are tested, if any of them
+        failed. Databases are tested in parallel only when engine is given
+        number of processes.
+        """
         target_id = self.pick_rev_id(target_id)
-        conns = self.backend.generate_test_connections()
+        conns = filter(self.in_shard, self.backend.generate_test_connections())
+
+        serial = not self._parallel_reads
+        tested = self._map("_test", conns, target_id, serial=serial)
+        results = dict(r for r in tested if r)
+        failed = sorted(db for db, error in results.items() if error)
+        for db in failed:
+            log.error("Testing failed for %s: %s", db, results[db])
+        log.info("Tested %s databases, %s failed", len(results), len(failed))
+        if failed:
+            raise exceptions.MigrationTestFailed(", ".join(failed))
+        return results
+
+    def _test(self, db: DBN, target_id: str) -> Optional[Tuple[str, Optional[str]]]:
+        try:
+            cdb = self.initialized_db(db)
+        except exceptions.DatabaseUnavailable:
+            return None
+        except Exception as e:
+            log.exception(f"{_pname()}: Testing failed for {db}")
+            return self._key(db), repr(e)
 
-        for db in conns:
-            try:
-                cdb = self.initialized_db(db)
-            except exceptions.DatabaseUnavailable:
-                continue
+        try:
             actions = self.calc_actions(cdb, target_id)
 
             # Perform 2 passes of up/down to make sure database is still
@@ -105,23 +812,39 @@ class MigrantEngine(Generic[DBN, DBC]):
                 log.info(f"PASS {testpass}. Testing downgrade for {cdb}")
                 reverted_actions = self.revert_actions(actions)
                 self.execute_actions(cdb, reverted_actions, strict=True)
+        except Exception as e:
+            log.exception(f"{_pname()}: Testing failed for {cdb}")
+            return self._key(db), repr(e)
 
-            log.info("Testing completed for %s" % cdb)
+        log.info("Testing completed for %s" % cdb)
+        return self._key(db), None
 
     def initialized_db(self, db: DBN) -> DBC:
+        cdb = self._connect(db)
+        self._ensure_initialized(cdb)
+        return cdb
+
+    def _connect(self, db: DBN) -> DBC:
         log.info(f"{_pname()}: Preparing migrations for {db}")
         try:
-            cdb = self.backend.begin(db)
+            with self._timed_call("begin", db):
+                return self.backend.begin(db)
         except exceptions.DatabaseUnavailable:
             log.warning(f"{_pname()}: Starting migration for {db}")
             raise
 
-        migrations = self.backend.list_migrations(cdb)
+    def _ensure_initialized(self, cdb: DBC) -> None:
+        with self._timed_call("list_migrations", cdb):
+            migrations = self.backend.list_migrations(cdb)
         if not migrations:
             latest_revid = self.pick_rev_id(None)
             self.initialize_db(cdb, latest_revid)
 
-        return cdb
+    def _is_current(self, cdb: DBC, fingerprint: str) -> bool:
+        """Check if database is known to be migrated to the state with given
+        fingerprint"""
+        with self._timed_call("read_fingerprint", cdb):
+            return self.backend.read_fingerprint(cdb) == fingerprint
 
     def initialize_db(self, db: DBC, initial_revid: str):
         """Iniitialize database that was never migrated before
@@ -130,70 +853,37 @@ class MigrantEngine(Generic[DBN, DBC]):
         """
         # We can assuming the current database state is fully up-to-date. This
         # is the same thing as if all past migrations were executed.
-        for sid in self.script_ids:
-            if sid != "INITIAL":
-                # Try to resolve into proper script name
-                script = self.repository.load_script(sid)
-                sid = script.name
-            self.backend.push_migration(db, sid)
+        names = ["INITIAL"] + self.script_names(self.script_ids[1:])
+        if not self.dry_run:
+            with self._timed_call("push_migrations", db):
+                self.backend.push_migrations(db, names)
 
         log.info(
-            f"{_pname()}: Initialized migrations for {db}. Assuming database is at {sid}"
+            f"{_pname()}: Initialized migrations for {db}"
+            f"{' (not really)' if self.dry_run else ''}. "
+            f"Assuming database is at {names[-1]}"
         )
 
-    def pick_rev_id(self, rev_id: Optional[str] = None) -> str:
-        if rev_id is None:
-            # Pick latest one
-            rev_id = self.script_ids[-1]
-
-        if canonical_rev_id(rev_id) not in self.script_ids:
-            raise exceptions.ScriptNotFoundError(rev_id)
-
-        return rev_id
-
     def calc_actions(self, db: DBC, target_revid: str) -> Actions:
         """Caclulate actions, required to update to revision `target_revid`
         """
-        target_revid = canonical_rev_id(target_revid)
-        assert target_revid in self.script_ids
         migrations = self.list_backend_migrations(db)
+        if not migrations and self.dry_run:
+            # Database is not really initialized in dry run
+            migrations = self.script_ids
         assert len(migrations) > 0, "Migrations are initialized"
-
-        script_idx = {v: idx for idx, v in enumerate(self.script_ids)}
-
-        migrations = [m for m in migrations if m in script_idx]
-        migrations = sorted(migrations, key=lambda m: script_idx[m])
-
-        if not migrations:
-            log.warning(
-                "No common revision between repository and "
-                "database %s. Running all migrations up to %s",
-                db,
-                target_revid,
-            )
-            base_revid = "INITIAL"
-        else:
-            base_revid = migrations[0]
-
-        base_idx = script_idx[base_revid]
-        target_idx = script_idx[target_revid]
-
-        toremove = [m for m in reversed(migrations) if script_idx[m] > target_idx]
-        toadd = [
-            s
-            for s in self.script_ids
-            if base_idx < script_idx[s] <= target_idx and s not in migrations
-        ]
-        return [("-", rid) for rid in toremove] + [("+", rid) for rid in toadd]
-
-    def revert_actions(self, actions: Actions) -> Actions:
-        reverts = [("+" if a == "-" else "-", script) for a, script in actions]
-        return list(reversed(reverts))
+        return list(self._plan_migrations(db, migrations, target_revid))
 
     def list_backend_migrations(self, db: DBC) -> List[str]:
-        return [canonical_rev_id(revid) for revid in self.backend.list_migrations(db)]
+        with self._timed_call("list_migrations", db):
+            migrations = self.backend.list_migrations(db)
+        return [canonical_rev_id(revid) for revid in migrations]
 
     def execute_actions(self, db: DBC, actions: Actions, strict: bool = False) -> None:
+        if self.stamp:
+            self.stamp_actions(db, actions)
+            return
+
         for action, revid in actions:
             script = self.repository.load_script(revid)
             assert action in ("+", "-")
@@ -216,16 +906,109 @@ class MigrantEngine(Generic[DBN, DBC]):
                 " (not really)" if self.dry_run else "",
             )
             if not self.dry_run:
-                if strict:
-                    before(db)
-                during(db)
-                if strict:
-                    after(db)
+                with self._script_slot(revid):
+                    self._emit(
+                        events.SCRIPT_STARTED, db, script=script.name, action=action
+                    )
+                    started = time.perf_counter()
+                    if strict:
+                        _check_sync(script, before(db))
+                    _check_sync(script, during(db))
+                    if strict:
+                        _check_sync(script, after(db))
                 end(db, script.name)
+                self._emit(
+                    events.SCRIPT_FINISHED,
+                    db,
+                    script=script.name,
+                    action=action,
+                    duration=time.perf_counter() - started,
+                )
+
+    def _script_slot(self, revid: str) -> ContextManager[Any]:
+        """Return context, that limits number of concurrent runs of the script
+        """
+        semaphore = self._script_semaphores.get(revid)
+        if semaphore is None:
+            return contextlib.nullcontext()
+        return semaphore
+
+    def stamp_actions(self, db: DBC, actions: Actions) -> None:
+        """Record actions as performed without executing migration scripts
+        """
+        for action, group in itertools.groupby(actions, key=lambda a: a[0]):
+            assert action in ("+", "-")
+            names = self.script_names([revid for _, revid in group])
+            for name in names:
+                log.info(
+                    "Stamping %s as %s%s",
+                    name,
+                    "applied" if action == "+" else "reverted",
+                    " (not really)" if self.dry_run else "",
+                )
+            if self.dry_run:
+                continue
+            if action == "+":
+                self.backend.push_migrations(db, names)
+            else:
+                self.backend.pop_migrations(db, names)
+
+
+# Engine of the pool worker process, installed by `_init_worker`
+_worker_engine: Optional[MigrantEngine] = None
+
+
+def _init_worker(engine: MigrantEngine) -> None:
+    global _worker_engine
+    _worker_engine = engine
+
+
+def _pool_call(
+    method: str, args: Tuple[Any, ...], db: Any
+) -> Tuple[Any, List[Event], Optional[profiling.ProfileData]]:
+    """Call engine method in pool worker, collecting events, when parent has
+    an observer, and profile data, when profiling, for the parent"""
+    engine = _worker_engine
+    assert engine is not None, "Worker is initialized"
+    worker_events: List[Event] = []
+    if engine.observer is not None:
+        buffer = EventBuffer()
+        engine.observer = buffer
+        worker_events = buffer.events
+    if engine.profile is None:
+        return getattr(engine, method)(db, *args), worker_events, None
+    result, data = profiling.profiled(getattr(engine, method), db, *args)
+    return result, worker_events, data
+
+
+def _check_sync(script: Any, result: Any) -> None:
+    if inspect.iscoroutine(result):
+        result.close()
+        raise exceptions.ConfigurationError(
+            f"Script {script.name} is asynchronous, it requires asynchronous backend"
+        )
+
+
+def _overrides(backend: Any, method: str) -> bool:
+    """Check whether backend implements optional method"""
+    return getattr(type(backend), method, None) is not getattr(MigrantBackend, method)
+
+
+def _batches(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
 
 
 def _pname() -> str:
-    return multiprocessing.current_process().name
+    name = multiprocessing.current_process().name
+    thread = threading.current_thread()
+    if thread is not threading.main_thread():
+        name = f"{name}/{thread.name}"
+    return name
 
 
 def canonical_rev_id(migration_name: str) -> str:
@@ -0,0 +1,97 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+from typing import List, NamedTuple, Optional
+
+# Event kinds
+DB_QUEUED = "db_queued"
+DB_STARTED = "db_started"
+DB_SKIPPED = "db_skipped"
+DB_COMMITTED = "db_committed"
+DB_ABORTED = "db_aborted"
+BACKEND_CALL = "backend_call"
+SCRIPT_STARTED = "script_started"
+SCRIPT_FINISHED = "script_finished"
+
+
+class Event(NamedTuple):
+    """Structured event, reported by the engine to its observer
+
+    Events are plain picklable values, so they can be passed from pool
+    workers to the parent process.
+    """
+
+    kind: str
+    # String representation of the database
+    db: str
+    # Name of the process, where event happened
+    process: str
+    timestamp: float
+    # Script name, for script events
+    script: Optional[str] = None
+    # "+" or "-", for script events
+    action: Optional[str] = None
+    # Backend method name, for backend call events
+    call: Optional[str] = None
+    # Duration in seconds, for events that complete some work
+    duration: Optional[float] = None
+    # Error description, for aborted and skipped databases
+    error: Optional[str] = None
+
+
+class MigrantObserver:
+    """Base class for engine observers
+
+    Engine calls `notify` for each event. Default implementation dispatches
+    event to the method, named after event kind. Events, happened in pool
+    workers, are delivered in the parent process after database is processed.
+    """
+
+    def notify(self, event: Event) -> None:
+        getattr(self, event.kind)(event)
+
+    def db_queued(self, event: Event) -> None:
+        """Database is generated by backend and queued for processing
+
+        This event always happens in the parent process.
+        """
+
+    def db_started(self, event: Event) -> None:
+        """Processing of database is started"""
+
+    def db_skipped(self, event: Event) -> None:
+        """Database is skipped, because it is not available or is known to be
+        up-to-date"""
+
+    def db_committed(self, event: Event) -> None:
+        """Migration of database completed and committed
+
+        Event duration is the total time spent on the database.
+        """
+
+    def db_aborted(self, event: Event) -> None:
+        """Migration of database failed and aborted
+
+        Event duration is the total time spent on the database.
+        """
+
+    def backend_call(self, event: Event) -> None:
+        """Backend method call completed"""
+
+    def script_started(self, event: Event) -> None:
+        """Migration script is about to be executed"""
+
+    def script_finished(self, event: Event) -> None:
+        """Migration script is executed"""
+
+
+class EventBuffer(MigrantObserver):
+    """Observer, that just collects events"""
+
+    def __init__(self) -> None:
+        self.events: List[Event] = []
+
+    def notify(self, event: Event) -> None:
+        self.events.append(event)
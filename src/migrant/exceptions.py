@@ -40,3 +40,13 @@ class BackendNameConflict(MigrantException):
 
 class DatabaseUnavailable(MigrantException):
     """Raised by backend when database is not available for processing"""
+
+
+class MigrationTestFailed(MigrantException):
+    def __str__(self):
+        return "Migration tests failed for: %s" % self.args
+
+
+class MigrationFailed(MigrantException):
+    def __str__(self):
+        return "Migration failed for %s databases" % self.args
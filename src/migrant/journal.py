@@ -0,0 +1,57 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+import sqlite3
+
+
+class Journal:
+    """Local record of databases, completed by upgrade runs
+
+    Databases are recorded with fingerprint of the repository state they were
+    migrated to (see `EngineBase.fingerprint`), so the record is only valid
+    for the same target revision and the same set of scripts. `scope`
+    separates databases of different configurations, sharing the journal
+    file.
+
+    Journal is only accessed from the process, that runs the upgrade.
+    """
+
+    def __init__(self, fname: str, scope: str = "") -> None:
+        self.fname = fname
+        self.scope = scope
+        self.conn = sqlite3.connect(fname)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS completed ("
+            " scope TEXT NOT NULL,"
+            " fingerprint TEXT NOT NULL,"
+            " db TEXT NOT NULL,"
+            " PRIMARY KEY (scope, fingerprint, db))"
+        )
+        self.conn.commit()
+
+    def is_completed(self, fingerprint: str, db: str) -> bool:
+        cur = self.conn.execute(
+            "SELECT 1 FROM completed WHERE scope=? AND fingerprint=? AND db=?",
+            (self.scope, fingerprint, db),
+        )
+        return cur.fetchone() is not None
+
+    def record(self, fingerprint: str, db: str) -> None:
+        """Record database as completed
+
+        Record is committed immediately, so it survives interruption of the
+        run.
+        """
+        self.conn.execute(
+            "INSERT OR IGNORE INTO completed (scope, fingerprint, db) "
+            "VALUES (?, ?, ?)",
+            (self.scope, fingerprint, db),
+        )
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,124 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import cProfile
+import os
+import pstats
+
+# Raw profile data, as collected by `cProfile.Profile.create_stats`
+ProfileData = Dict[Tuple[str, int, str], Any]
+
+# Functions of migration scripts, that engine calls
+SCRIPT_FUNCTIONS = (
+    "up",
+    "down",
+    "test_before_up",
+    "test_after_up",
+    "test_before_down",
+    "test_after_down",
+)
+
+
+def profiled(func: Callable[..., Any], *args: Any) -> Tuple[Any, ProfileData]:
+    """Call `func` under profiler and return its result and raw profile data
+
+    Profile data is a plain dict, so it can be passed from pool worker to the
+    parent process.
+    """
+    prof = cProfile.Profile()
+    result = prof.runcall(func, *args)
+    prof.create_stats()
+    return result, prof.stats  # type: ignore
+
+
+class _RawProfile:
+    """Raw profile data in the form, accepted by `pstats.Stats.add`"""
+
+    def __init__(self, stats: ProfileData) -> None:
+        self.stats = stats
+
+    def create_stats(self) -> None:
+        pass
+
+
+class ProfileStats:
+    """Profile, merged from profiles of databases, processed in all workers"""
+
+    def __init__(self) -> None:
+        self.stats: Optional[pstats.Stats] = None
+
+    def add(self, data: ProfileData) -> None:
+        if self.stats is None:
+            self.stats = pstats.Stats()
+        self.stats.add(_RawProfile(data))  # type: ignore
+
+    @property
+    def data(self) -> ProfileData:
+        """Merged raw profile data"""
+        if self.stats is None:
+            return {}
+        return self.stats.stats  # type: ignore
+
+    def dump(self, fname: str) -> None:
+        """Write merged profile to a file, that can be read by `pstats`"""
+        if self.stats is None:
+            self.stats = pstats.Stats()
+        self.stats.dump_stats(fname)
+
+    def top_functions(self, limit: int = 10) -> List[Tuple[str, int, float, float]]:
+        """Return functions, that took most time on their own
+
+        Each function is reported with number of calls, own and cumulative
+        time.
+        """
+        rows = [
+            (_func_name(func), nc, tt, ct)
+            for func, (cc, nc, tt, ct, callers) in self.data.items()
+        ]
+        rows.sort(key=lambda r: -r[2])
+        return rows[:limit]
+
+    def script_times(self, script_files: Dict[str, str]) -> Dict[str, float]:
+        """Return cumulative time, spent in each migration script
+
+        `script_files` maps script file names to script names. Time of
+        `up`, `down` and test functions, defined in these files, is summed
+        up.
+        """
+        times: Dict[str, float] = {}
+        files = {_normpath(f): name for f, name in script_files.items()}
+        for (fname, _, funcname), stat in self.data.items():
+            if funcname not in SCRIPT_FUNCTIONS:
+                continue
+            name = files.get(_normpath(fname))
+            if name is not None:
+                times[name] = times.get(name, 0.0) + stat[3]
+        return times
+
+    def summary(self, script_files: Dict[str, str], limit: int = 10) -> List[str]:
+        lines = [f"Top {limit} functions by own time:"]
+        for func, calls, tottime, cumtime in self.top_functions(limit):
+            lines.append(
+                f"  {tottime:9.3f}s own {cumtime:9.3f}s cum {calls:8} calls {func}"
+            )
+        times = self.script_times(script_files)
+        if times:
+            lines.append("Cumulative time per migration script:")
+            for name, seconds in sorted(times.items(), key=lambda t: -t[1]):
+                lines.append(f"  {seconds:9.3f}s {name}")
+        return lines
+
+
+def _func_name(func: Tuple[str, int, str]) -> str:
+    fname, line, name = func
+    if fname == "~":
+        # Built-in function
+        return name
+    return f"{os.path.basename(fname)}:{line}({name})"
+
+
+def _normpath(fname: str) -> str:
+    return os.path.normcase(os.path.abspath(fname))
@@ -0,0 +1,143 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+from typing import Callable, Deque, Optional, TextIO
+import collections
+import datetime
+import logging
+import sys
+import time
+
+from migrant.events import Event, MigrantObserver
+
+log = logging.getLogger(__name__)
+
+# Seconds between redraws of the progress line on terminal
+TTY_INTERVAL = 0.2
+
+
+class ProgressReporter(MigrantObserver):
+    """Report progress of the fleet upgrade
+
+    Shows number of processed databases, throughput, number of databases in
+    flight and failures so far. When `total` number of databases is known,
+    estimated time to completion is shown as well. ETA is based on throughput
+    over last `window` processed databases.
+
+    Databases are taken from backend only as workers free up, so number of
+    queued databases is not the total.
+
+    On terminal, progress line is redrawn in place. Otherwise, e.g. for cron
+    runs, progress is logged at most every `interval` seconds.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        stream: Optional[TextIO] = None,
+        interval: float = 30.0,
+        window: int = 50,
+        clock: Callable[[], float] = time.monotonic,
+        total: Optional[int] = None,
+    ) -> None:
+        self.workers = workers
+        self.stream = stream if stream is not None else sys.stderr
+        self.tty = self.stream.isatty()
+        self.interval = interval
+        self.clock = clock
+        self.total = total
+
+        self.queued = 0
+        self.done = 0
+        self.failed = 0
+        # Times, when last `window` databases were processed
+        self.finished: Deque[float] = collections.deque(maxlen=window)
+        self.started = clock()
+        self._reported = self.started
+
+    @property
+    def in_flight(self) -> int:
+        return min(self.workers, self.queued - self.done)
+
+    def throughput(self) -> float:
+        """Processed databases per minute"""
+        elapsed = self.clock() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.done * 60 / elapsed
+
+    def recent_throughput(self) -> float:
+        """Processed databases per minute, over last `window` databases"""
+        if len(self.finished) < (self.finished.maxlen or 0):
+            return self.throughput()
+        elapsed = self.clock() - self.finished[0]
+        if elapsed <= 0:
+            return 0.0
+        return (len(self.finished) - 1) * 60 / elapsed
+
+    def eta(self) -> Optional[float]:
+        """Estimated number of seconds till all databases are processed
+
+        Return `None`, when total number of databases is not known, or
+        nothing is processed yet.
+        """
+        if self.total is None:
+            return None
+        throughput = self.recent_throughput()
+        if not throughput:
+            return None
+        return max(self.total - self.done, 0) * 60 / throughput
+
+    def format(self) -> str:
+        eta = self.eta()
+        etastr = "?" if eta is None else str(datetime.timedelta(seconds=int(eta)))
+        processed = str(self.done)
+        if self.total is not None:
+            processed += f"/{self.total}"
+        return (
+            f"Processed {processed} databases, "
+            f"{self.failed} failed, {self.in_flight} in flight, "
+            f"{self.throughput():.1f} DBs/min, ETA {etastr}"
+        )
+
+    def db_queued(self, event: Event) -> None:
+        self.queued += 1
+        self._report()
+
+    def db_skipped(self, event: Event) -> None:
+        self._finished()
+
+    def db_committed(self, event: Event) -> None:
+        self._finished()
+
+    def db_aborted(self, event: Event) -> None:
+        self.failed += 1
+        self._finished()
+
+    def finish(self) -> None:
+        """Report final state, when run is completed"""
+        if self.tty:
+            self.stream.write("\r" + self.format() + "\n")
+            self.stream.flush()
+        else:
+            log.info(self.format())
+
+    def _finished(self) -> None:
+        self.done += 1
+        self.finished.append(self.clock())
+        self._report()
+
+    def _report(self) -> None:
+        now = self.clock()
+        interval = TTY_INTERVAL if self.tty else self.interval
+        if now - self._reported < interval:
+            return
+        self._reported = now
+
+        if self.tty:
+            self.stream.write("\r" + self.format() + "\x1b[K")
+            self.stream.flush()
+        else:
+            log.info(self.format())
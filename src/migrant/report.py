@@ -0,0 +1,141 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+from typing import Any, Dict, List, NamedTuple, Optional, TextIO, Tuple
+import json
+import sys
+
+# Database statuses
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+STATUSES = (SUCCEEDED, FAILED, SKIPPED)
+
+
+class DbResult(NamedTuple):
+    """Outcome of database migration"""
+
+    db: str
+    status: str
+    # Error description for failed databases, reason for skipped ones
+    error: Optional[str] = None
+    # Seconds spent on the database
+    duration: Optional[float] = None
+
+
+class UpdateReport:
+    """Summary of the fleet upgrade"""
+
+    def __init__(self) -> None:
+        self.results: List[DbResult] = []
+
+    def add(self, result: DbResult) -> None:
+        self.results.append(result)
+
+    def by_status(self, status: str) -> List[DbResult]:
+        return [r for r in self.results if r.status == status]
+
+    @property
+    def succeeded(self) -> List[DbResult]:
+        return self.by_status(SUCCEEDED)
+
+    @property
+    def failed(self) -> List[DbResult]:
+        return self.by_status(FAILED)
+
+    @property
+    def skipped(self) -> List[DbResult]:
+        return self.by_status(SKIPPED)
+
+    def summary(self) -> str:
+        counts = ", ".join(f"{len(self.by_status(s))} {s}" for s in STATUSES)
+        return f"Processed {len(self.results)} databases: {counts}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {s: len(self.by_status(s)) for s in STATUSES}
+        data["databases"] = [r._asdict() for r in self.results]
+        return data
+
+    def write(self, fname: str) -> None:
+        """Write report as JSON to a file, "-" stands for standard output"""
+        if fname == "-":
+            json.dump(self.to_dict(), sys.stdout, indent=2)
+            sys.stdout.write("\n")
+            return
+        with open(fname, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+PlanActions = Tuple[Tuple[str, str], ...]
+
+
+class FleetPlan:
+    """Pending actions of all databases, grouped by databases that need the
+    same actions"""
+
+    def __init__(self, target_id: str) -> None:
+        self.target_id = target_id
+        self.groups: Dict[PlanActions, List[str]] = {}
+        self.unavailable: List[str] = []
+
+    def add(self, db: str, actions: Optional[List[Tuple[str, str]]]) -> None:
+        """Add database with its pending actions, `None` if it is unavailable
+        """
+        if actions is None:
+            self.unavailable.append(db)
+        else:
+            self.groups.setdefault(tuple(actions), []).append(db)
+
+    @property
+    def total(self) -> int:
+        return sum(len(dbs) for dbs in self.groups.values()) + len(self.unavailable)
+
+    def sorted_groups(self) -> List[Tuple[PlanActions, List[str]]]:
+        """Groups, largest first"""
+        return sorted(self.groups.items(), key=lambda g: -len(g[1]))
+
+    def lines(self) -> List[str]:
+        lines = [f"Plan to migrate {self.total:,} databases to {self.target_id}:"]
+        for actions, dbs in self.sorted_groups():
+            if actions:
+                steps = " ".join(f"{action}{revid}" for action, revid in actions)
+                lines.append(f"{len(dbs):,} DBs need {steps}")
+            else:
+                lines.append(f"{len(dbs):,} DBs up-to-date")
+        if self.unavailable:
+            lines.append(f"{len(self.unavailable):,} unavailable")
+        return lines
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "target": self.target_id,
+            "databases": self.total,
+            "groups": [
+                {
+                    "actions": [list(a) for a in actions],
+                    "count": len(dbs),
+                    "databases": dbs,
+                }
+                for actions, dbs in self.sorted_groups()
+            ],
+            "unavailable": self.unavailable,
+        }
+
+    def write(self, fname: str, format: str = "text") -> None:
+        """Write plan as text or JSON to a file, "-" stands for standard
+        output"""
+        if fname == "-":
+            self._write(sys.stdout, format)
+            return
+        with open(fname, "w") as f:
+            self._write(f, format)
+
+    def _write(self, f: TextIO, format: str) -> None:
+        if format == "json":
+            json.dump(self.to_dict(), f, indent=2)
+            f.write("\n")
+        else:
+            f.write("\n".join(self.lines()) + "\n")
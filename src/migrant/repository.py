@@ -3,11 +3,16 @@
 # Copyright 2014 by Shoobx, Inc.
 #
 ###############################################################################
-from typing import List
+from typing import Any, Callable, List, Dict, Tuple, Optional
 import os
+import ast
+import sys
+import types
+import marshal
 import logging
 import string
 import hashlib
+import threading
 import importlib.util
 
 log = logging.getLogger(__name__)
@@ -21,6 +26,10 @@ INITIAL_SCRIPTLIST = """
 """.lstrip()
 
 
+# Precompiled scripts, written by `migrant compile` to repository directory
+BUNDLE_FNAME = "scripts.bundle"
+BUNDLE_VERSION = 1
+
 SCRIPT_TEMPLATE = '''"""%(title)s"""
 
 
@@ -58,10 +67,28 @@ class Script:
     rev_id: str
     name: str
 
-    def __init__(self, filename):
+    def __init__(self, filename, code=None):
         assert filename.endswith(".py")
+        self.filename = filename
         self.name = os.path.basename(filename)[:-3]
-        self.module = self._load_module_from_file(self.name, filename)
+        # Module is executed on first use, so that scripts can be listed,
+        # stamped and planned without running their code
+        self._code = code
+        self._module = None
+        self._module_lock = threading.Lock()
+
+    @property
+    def module(self):
+        if self._module is None:
+            with self._module_lock:
+                if self._module is None:
+                    self._module = self._load_module()
+        return self._module
+
+    def _load_module(self):
+        if self._code is None:
+            return self._load_module_from_file(self.name, self.filename)
+        return self._load_module_from_code(self.name, self.filename, self._code)
 
     def _load_module_from_file(self, name, path):
         spec = importlib.util.spec_from_file_location(name, path)
@@ -69,23 +96,73 @@ class Script:
         spec.loader.exec_module(module)
         return module
 
+    def _load_module_from_code(self, name, path, code):
+        module = types.ModuleType(name)
+        module.__file__ = path
+        exec(code, module.__dict__)
+        return module
+
+    @property
+    def title(self) -> str:
+        """First line of script docstring
+
+        Docstring is read from the source, unless module is already executed.
+        """
+        if self._module is not None:
+            doc = self._module.__doc__
+        else:
+            doc = ast.get_docstring(self._parse())
+        return (doc or "").split("\n")[0]
+
+    @property
+    def max_concurrency(self) -> Optional[int]:
+        """Maximum number of databases, this script may migrate at once
+
+        Plain literal assignment is read from the source without executing
+        the module.
+        """
+        if self._module is None:
+            for node in self._parse().body:
+                if isinstance(node, ast.Assign):
+                    targets, value = node.targets, node.value
+                elif isinstance(node, ast.AnnAssign) and node.value is not None:
+                    targets, value = [node.target], node.value
+                else:
+                    continue
+                if any(
+                    isinstance(t, ast.Name) and t.id == "max_concurrency"
+                    for t in targets
+                ):
+                    try:
+                        return ast.literal_eval(value)
+                    except ValueError:
+                        # Computed limit, module has to be executed
+                        break
+            else:
+                return None
+        return getattr(self.module, "max_concurrency", None)
+
+    def _parse(self) -> ast.Module:
+        with open(self.filename, "rb") as f:
+            return ast.parse(f.read(), self.filename)
+
     def up(self, db):
-        self._exec("up", db)
+        return self._exec("up", db)
 
     def down(self, db):
-        self._exec("down", db)
+        return self._exec("down", db)
 
     def test_before_up(self, db):
-        self._exec("test_before_up", db)
+        return self._exec("test_before_up", db)
 
     def test_after_up(self, db):
-        self._exec("test_after_up", db)
+        return self._exec("test_after_up", db)
 
     def test_before_down(self, db):
-        self._exec("test_before_down", db)
+        return self._exec("test_before_down", db)
 
     def test_after_down(self, db):
-        self._exec("test_after_down", db)
+        return self._exec("test_after_down", db)
 
     def _exec(self, method, *args, **kwargs):
         __traceback_info__ = (args, kwargs)
@@ -95,6 +172,79 @@ class Script:
         return getattr(self.module, method)(*args, **kwargs)
 
 
+# Per-process cache of loaded scripts. Maps full script filename to a
+# (mtime, size) stamp and the script, loaded from the file with that stamp.
+_script_cache: Dict[str, Tuple[Tuple[int, int], Script]] = {}
+_script_cache_lock = threading.Lock()
+
+
+def load_cached_script(
+    filename: str, loader: Callable[[str], Script] = Script
+) -> Script:
+    """Load script from file, reusing previously loaded one if file did not
+    change since then.
+
+    Script is loaded with `loader`, called with file name.
+    """
+    st = os.stat(filename)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _script_cache.get(filename)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    with _script_cache_lock:
+        # Script might have been loaded by another thread in the meantime
+        cached = _script_cache.get(filename)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        script = loader(filename)
+        _script_cache[filename] = (stamp, script)
+    return script
+
+
+# Per-process cache of loaded bundles. Maps full bundle filename to a
+# (mtime, size) stamp and bundled scripts, keyed by script file name.
+_bundle_cache: Dict[str, Tuple[Tuple[int, int], Dict[str, Dict[str, Any]]]] = {}
+
+
+def load_bundle(filename: str) -> Dict[str, Dict[str, Any]]:
+    """Load bundle of precompiled scripts, written by
+    `DirectoryRepository.compile`
+
+    Return bundled scripts keyed by script file name. Missing bundle or bundle,
+    compiled by different Python version, is treated as empty one.
+    """
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return {}
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _bundle_cache.get(filename)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    with open(filename, "rb") as f:
+        try:
+            bundle = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            bundle = None
+    if (
+        not isinstance(bundle, dict)
+        or bundle.get("version") != BUNDLE_VERSION
+        or bundle.get("python") != sys.implementation.cache_tag
+    ):
+        log.warning("Ignoring incompatible script bundle %s" % filename)
+        scripts: Dict[str, Dict[str, Any]] = {}
+    else:
+        scripts = {entry["fname"]: entry for entry in bundle["scripts"]}
+    _bundle_cache[filename] = (stamp, scripts)
+    return scripts
+
+
+def source_hash(source: bytes) -> str:
+    return hashlib.sha1(source).hexdigest()
+
+
 class Repository:
     def new_script(self, title: str) -> str:
         raise NotImplementedError()
@@ -105,11 +255,21 @@ class Repository:
     def load_script(self, scriptid: str) -> Script:
         raise NotImplementedError()
 
+    def script_name(self, scriptid: str) -> str:
+        """Return name of the script, as recorded by backends"""
+        return self.load_script(scriptid).name
+
+    def script_title(self, scriptid: str) -> str:
+        return self.load_script(scriptid).title
+
 
 class DirectoryRepository(Repository):
     def __init__(self, directory):
         self.directory = directory
         self.scriptlist_fname = os.path.join(self.directory, "scripts.lst")
+        self.bundle_fname = os.path.join(self.directory, BUNDLE_FNAME)
+        # Maps revision id to script file name. Built on first use.
+        self._script_index: Optional[Dict[str, str]] = None
 
     def init(self):
         if not os.path.exists(self.directory):
@@ -147,6 +307,7 @@ class DirectoryRepository(Repository):
         with open(self.scriptlist_fname, "a") as lf:
             lf.write(fname)
             lf.write("\n")
+        self._script_index = None
 
         log.info("Script %s created" % fullfname)
         return revname
@@ -180,20 +341,107 @@ class DirectoryRepository(Repository):
         return scripts
 
     def load_script(self, scriptid):
-        self.check_repo()
-
-        # Find script with given id
-        fname = None
-        for fname in os.listdir(self.directory):
-            if not fname.endswith(".py"):
-                continue
+        fname = self.find_script_fname(scriptid)
+        try:
+            return load_cached_script(
+                os.path.join(self.directory, fname), self._load_script_file
+            )
+        except FileNotFoundError:
+            pass
+
+        # Script might have been renamed or removed since index was built
+        self._script_index = None
+        fname = self.find_script_fname(scriptid)
+        try:
+            return load_cached_script(
+                os.path.join(self.directory, fname), self._load_script_file
+            )
+        except FileNotFoundError:
+            raise exceptions.ScriptNotFoundError(scriptid)
 
-            if fname.startswith("%s_" % scriptid):
-                break
-        else:
+    def script_name(self, scriptid: str) -> str:
+        # Name is known from file name, script is not even loaded
+        return self.find_script_fname(scriptid)[:-3]
+
+    def _load_script_file(self, filename: str) -> Script:
+        """Load script from the bundle, falling back to the source when
+        script is not bundled or changed since the bundle was compiled"""
+        entry = load_bundle(self.bundle_fname).get(os.path.basename(filename))
+        if entry is not None:
+            with open(filename, "rb") as f:
+                if source_hash(f.read()) == entry["hash"]:
+                    return Script(filename, entry["code"])
+            log.debug("Bundled script %s is stale" % entry["fname"])
+        return Script(filename)
+
+    def compile(self) -> int:
+        """Compile all scripts to the bundle, that is loaded instead of
+        script sources
+
+        Return number of compiled scripts.
+        """
+        entries = []
+        for revid, fname in sorted(self._build_script_index().items()):
+            fullfname = os.path.join(self.directory, fname)
+            with open(fullfname, "rb") as f:
+                source = f.read()
+            tree = ast.parse(source, fullfname)
+            docstring = ast.get_docstring(tree) or ""
+            entries.append(
+                {
+                    "revid": revid,
+                    "fname": fname,
+                    "name": fname[:-3],
+                    "title": docstring.split("\n")[0],
+                    "hash": source_hash(source),
+                    "code": compile(tree, fullfname, "exec", dont_inherit=True),
+                }
+            )
+
+        bundle = {
+            "version": BUNDLE_VERSION,
+            "python": sys.implementation.cache_tag,
+            "scripts": entries,
+        }
+        # Replace bundle atomically, workers may be reading it
+        tmpfname = self.bundle_fname + ".tmp"
+        with open(tmpfname, "wb") as f:
+            marshal.dump(bundle, f)
+        os.replace(tmpfname, self.bundle_fname)
+        return len(entries)
+
+    def manifest(self) -> List[Dict[str, str]]:
+        """Return revision id, name, title and source hash of bundled scripts
+        """
+        return [
+            {k: v for k, v in entry.items() if k != "code"}
+            for entry in load_bundle(self.bundle_fname).values()
+        ]
+
+    def find_script_fname(self, scriptid: str) -> str:
+        """Return file name of script with given revision id"""
+        if self._script_index is not None:
+            fname = self._script_index.get(scriptid)
+            if fname is not None:
+                return fname
+
+        # Script might have been added since index was built, rescan the
+        # directory
+        self._script_index = self._build_script_index()
+        fname = self._script_index.get(scriptid)
+        if fname is None:
             raise exceptions.ScriptNotFoundError(scriptid)
+        return fname
 
-        return Script(os.path.join(self.directory, fname))
+    def _build_script_index(self) -> Dict[str, str]:
+        self.check_repo()
+
+        index: Dict[str, str] = {}
+        for fname in sorted(os.listdir(self.directory)):
+            if not self.is_valid_scriptname(fname):
+                continue
+            index.setdefault(self.fname_to_revid(fname), fname)
+        return index
 
     def is_valid_scriptname(self, fname):
         return "_" in fname and fname.endswith(".py")
@@ -0,0 +1,128 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+from typing import AsyncIterator, Dict, List
+import asyncio
+
+import pytest
+
+from migrant import exceptions
+from migrant.aio import AsyncMigrantBackend, AsyncMigrantEngine
+from migrant.repository import Repository, Script
+
+
+class AsyncMemoryBackend(AsyncMigrantBackend[str, str]):
+    def __init__(self, dbs: List[str]) -> None:
+        self.dbs = dbs
+        self.applied: Dict[str, List[str]] = {db: ["INITIAL"] for db in dbs}
+        self.data: Dict[str, List[str]] = {db: [] for db in dbs}
+        self.unavailable_dbs: List[str] = []
+        self.committed: List[str] = []
+        self.inflight = 0
+        self.max_inflight = 0
+
+    async def generate_connections(self) -> AsyncIterator[str]:
+        for db in self.dbs:
+            yield db
+
+    async def begin(self, db: str) -> str:
+        if db in self.unavailable_dbs:
+            raise exceptions.DatabaseUnavailable(db)
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        return db
+
+    async def commit(self, db: str) -> None:
+        self.committed.append(db)
+
+    async def cleanup(self, db: str) -> None:
+        self.inflight -= 1
+
+    async def list_migrations(self, db: str) -> List[str]:
+        return list(self.applied[db])
+
+    async def push_migration(self, db: str, migration: str) -> None:
+        self.applied[db].append(migration)
+
+    async def pop_migration(self, db: str, migration: str) -> None:
+        self.applied[db].remove(migration)
+
+
+class AsyncScript(Script):
+    def __init__(self, name: str, backend: AsyncMemoryBackend) -> None:
+        self.name = name
+        self.backend = backend
+
+    async def up(self, db):
+        await asyncio.sleep(0.01)
+        self.backend.data[db].append(self.name)
+
+    def down(self, db):
+        self.backend.data[db].remove(self.name)
+
+
+class AsyncRepo(Repository):
+    def __init__(self, backend: AsyncMemoryBackend) -> None:
+        self.backend = backend
+
+    def list_script_ids(self) -> List[str]:
+        return ["aaaa", "bbbb"]
+
+    def load_script(self, scriptid: str) -> Script:
+        return AsyncScript(scriptid, self.backend)
+
+
+def test_update() -> None:
+    # GIVEN
+    dbs = [f"db{n}" for n in range(20)]
+    backend = AsyncMemoryBackend(dbs)
+    backend.unavailable_dbs = ["db3"]
+    engine = AsyncMigrantEngine(backend, AsyncRepo(backend), {}, concurrency=5)
+
+    # WHEN
+    asyncio.run(engine.update())
+
+    # THEN
+    assert backend.applied["db0"] == ["INITIAL", "aaaa", "bbbb"]
+    assert backend.data["db0"] == ["aaaa", "bbbb"]
+    assert backend.data["db3"] == []
+    assert len(backend.committed) == 19
+    assert backend.max_inflight == 5
+
+
+def test_downgrade() -> None:
+    backend = AsyncMemoryBackend(["db1"])
+    backend.applied["db1"] = ["INITIAL", "aaaa", "bbbb"]
+    backend.data["db1"] = ["aaaa", "bbbb"]
+    engine = AsyncMigrantEngine(backend, AsyncRepo(backend), {})
+
+    asyncio.run(engine.update("aaaa"))
+
+    assert backend.applied["db1"] == ["INITIAL", "aaaa"]
+    assert backend.data["db1"] == ["aaaa"]
+
+
+def test_pending_actions() -> None:
+    backend = AsyncMemoryBackend(["db1", "db2", "db3"])
+    backend.applied["db2"] = []
+    backend.unavailable_dbs = ["db3"]
+    engine = AsyncMigrantEngine(backend, AsyncRepo(backend), {})
+
+    pending = asyncio.run(engine.pending_actions())
+
+    assert pending == {"db1": [("+", "aaaa"), ("+", "bbbb")], "db2": [], "db3": None}
+    assert backend.applied["db2"] == []
+
+
+def test_update_failure() -> None:
+    backend = AsyncMemoryBackend(["db1", "db2"])
+    # Missing bookkeeping for db1 breaks its migration
+    del backend.data["db1"]
+    engine = AsyncMigrantEngine(backend, AsyncRepo(backend), {})
+
+    with pytest.raises(KeyError):
+        asyncio.run(engine.update())
+
+    assert backend.committed == ["db2"]
@@ -9,12 +9,16 @@ import unittest
 import tempfile
 import shutil
 import textwrap
+import json
+import pstats
 import logging
+import mock
 import pytest
 from configparser import ConfigParser
 import multiprocessing
 
 from migrant import cli, backend, exceptions
+from migrant.aio import AsyncMigrantBackend
 
 
 HERE = os.path.dirname(__file__)
@@ -77,6 +81,12 @@ class MockedBackend(backend.MigrantBackend):
         """
         yield from self.dbs
 
+    def count_connections(self):
+        return len(self.dbs)
+
+    def database_key(self, db):
+        return db.name
+
     def generate_test_connections(self):
         return self.generate_connections()
 
@@ -91,6 +101,11 @@ class MockedBackend(backend.MigrantBackend):
         self.inits += 1
 
 
+class AsyncMockedBackend(AsyncMigrantBackend):
+    def generate_connections(self):
+        return []
+
+
 class ConfigTest(unittest.TestCase):
     def test_get_db_config(self):
         cp = ConfigParser()
@@ -113,6 +128,7 @@ class UpgradeTest(unittest.TestCase):
         self.db0 = MockedDb("db0", m)
         self.backend = MockedBackend([self.db0], m)
         migrant_backend.set(self.backend)
+        self.migrant_backend = migrant_backend
 
         migrant_ini = tmpdir.join("migrant.ini")
         migrant_ini.write(INTEGRATION_CONFIG)
@@ -144,6 +160,78 @@ class UpgradeTest(unittest.TestCase):
         log = self.logstream.getvalue()
         self.assertIn("Up-to-date", log)
 
+    def test_status_uninitialized(self):
+        args = cli.parser.parse_args(["test", "status"])
+        cli.dispatch(args, self.cfg)
+
+        log = self.logstream.getvalue()
+        self.assertIn("Up-to-date", log)
+        # Status never writes to the database
+        self.assertEqual(list(self.db0.migrations), [])
+
+    def test_status_parallel(self):
+        m = multiprocessing.Manager()
+        db1 = MockedDb("db1", m)
+        self.backend.dbs.append(db1)
+        self.db0.migrations.extend(["aaaa_first"])
+        db1.migrations.extend(["aaaa_first", "bbbb_second", "cccc_third"])
+
+        args = cli.parser.parse_args(["test", "status", "-j", "2"])
+        cli.dispatch(args, self.cfg)
+
+        log = self.logstream.getvalue()
+        self.assertIn("Pending actions: 2", log)
+        self.assertIn("Databases to migrate: 1 of 2", log)
+
+    def test_plan(self):
+        m = multiprocessing.Manager()
+        for name in ["db1", "db2"]:
+            db = MockedDb(name, m)
+            db.migrations.extend(["aaaa_first"])
+            self.backend.dbs.append(db)
+        self.db0.migrations.extend(["aaaa_first", "bbbb_second", "cccc_third"])
+        planfname = os.path.join(os.path.dirname(self.migrant_ini), "plan.json")
+
+        args = cli.parser.parse_args(
+            ["test", "plan", "-j", "2", "--format", "json", "-o", planfname]
+        )
+        cli.dispatch(args, self.cfg)
+
+        with open(planfname) as f:
+            plan = json.load(f)
+        self.assertEqual(plan["target"], "cccc")
+        self.assertEqual(plan["databases"], 3)
+        self.assertEqual(
+            plan["groups"][0],
+            {
+                "actions": [["+", "bbbb"], ["+", "cccc"]],
+                "count": 2,
+                "databases": mock.ANY,
+            },
+        )
+        self.assertEqual(sorted(plan["groups"][0]["databases"]), ["db1", "db2"])
+        self.assertEqual(plan["groups"][1]["databases"], ["db0"])
+        self.assertEqual(plan["groups"][1]["actions"], [])
+
+    def test_plan_text(self):
+        self.db0.migrations.extend(["aaaa_first"])
+
+        args = cli.parser.parse_args(["test", "plan"])
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            cli.dispatch(args, self.cfg)
+
+        self.assertEqual(
+            stdout.getvalue(),
+            "Plan to migrate 1 databases to cccc:\n1 DBs need +bbbb +cccc\n",
+        )
+
+    def test_dry_run_uninitialized(self):
+        args = cli.parser.parse_args(["test", "upgrade", "--dry-run"])
+        cli.dispatch(args, self.cfg)
+
+        # Dry run does not initialize the database
+        self.assertEqual(list(self.db0.migrations), [])
+
     def test_no_scripts(self):
         args = cli.parser.parse_args(["virgin", "upgrade"])
         cli.dispatch(args, self.cfg)
@@ -222,6 +310,175 @@ class UpgradeTest(unittest.TestCase):
         self.assertEqual(list(self.db0.migrations), ["aaaa_first"])
         self.assertEqual(dict(self.db0.data), {"value": "a"})
 
+    def test_upgrade_report(self):
+        reportfname = os.path.join(os.path.dirname(self.migrant_ini), "report.json")
+        args = cli.parser.parse_args(
+            ["test", "upgrade", "--keep-going", "--report", reportfname]
+        )
+        cli.dispatch(args, self.cfg)
+
+        with open(reportfname) as f:
+            summary = json.load(f)
+        self.assertEqual(summary["succeeded"], 1)
+        self.assertEqual(summary["failed"], 0)
+        self.assertEqual(summary["databases"][0]["status"], "succeeded")
+
+    def test_upgrade_resume(self):
+        reportfname = os.path.join(os.path.dirname(self.migrant_ini), "report.json")
+        args = cli.parser.parse_args(
+            ["-c", self.migrant_ini, "test", "upgrade", "--resume"]
+        )
+        cli.dispatch(args, self.cfg)
+        self.assertIn("cccc_third", self.db0.migrations)
+
+        # Resumed run skips completed database without connecting to it
+        self.backend.dbs.append(MockedDb("db1", multiprocessing.Manager()))
+        args = cli.parser.parse_args(
+            ["-c", self.migrant_ini, "test", "upgrade", "--resume"]
+            + ["--report", reportfname]
+        )
+        with mock.patch.object(
+            self.backend, "begin", side_effect=lambda db: db
+        ) as begin:
+            cli.dispatch(args, self.cfg)
+        begin.assert_called_once_with(self.backend.dbs[1])
+
+        with open(reportfname) as f:
+            summary = json.load(f)
+        self.assertEqual(summary["succeeded"], 1)
+        self.assertEqual(
+            summary["databases"][0],
+            {"db": "db0", "status": "skipped", "error": "journaled", "duration": None},
+        )
+
+    def test_upgrade_shard(self):
+        args = cli.parser.parse_args(["test", "upgrade", "--shard", "2/2"])
+        self.assertEqual(args.shard, (2, 2))
+        with pytest.raises(SystemExit):
+            cli.parser.parse_args(["test", "upgrade", "--shard", "3/2"])
+
+    def test_upgrade_per_group_limit(self):
+        args = cli.parser.parse_args(["test", "upgrade", "--per-group-limit", "2"])
+        self.assertEqual(args.per_group_limit, 2)
+        for value in ["0", "-1", "x"]:
+            with pytest.raises(SystemExit):
+                cli.parser.parse_args(["test", "upgrade", "--per-group-limit", value])
+
+    def test_upgrade_queue(self):
+        queuefname = os.path.join(os.path.dirname(self.migrant_ini), "queue.sqlite")
+        args = cli.parser.parse_args(["test", "upgrade", "--queue", queuefname])
+        cli.dispatch(args, self.cfg)
+        self.assertIn("cccc_third", self.db0.migrations)
+
+        # Worker finds queue drained
+        args = cli.parser.parse_args(["test", "worker", "--queue", queuefname])
+        cli.dispatch(args, self.cfg)
+
+    def test_async_unsupported_options(self):
+        self.migrant_backend.set(AsyncMockedBackend())
+        for command, options in [
+            ("upgrade", ["--per-group-limit", "1"]),
+            ("upgrade", ["--schedule", "cost"]),
+            ("status", ["--executor", "thread"]),
+            ("plan", ["--per-group-limit", "1"]),
+        ]:
+            args = cli.parser.parse_args(["test", command] + options)
+            with pytest.raises(exceptions.ConfigurationError, match=options[0]):
+                cli.dispatch(args, self.cfg)
+
+    def test_upgrade_queue_unsupported_options(self):
+        queuefname = os.path.join(os.path.dirname(self.migrant_ini), "queue.sqlite")
+        for options in [["--dry-run"], ["--stamp"], ["--schedule", "cost"]]:
+            args = cli.parser.parse_args(
+                ["test", "upgrade", "--queue", queuefname] + options
+            )
+            with pytest.raises(exceptions.ConfigurationError):
+                cli.dispatch(args, self.cfg)
+        args = cli.parser.parse_args(
+            ["-c", self.migrant_ini, "test", "upgrade", "--queue", queuefname]
+            + ["--dry-run", "--resume"]
+        )
+        with pytest.raises(exceptions.ConfigurationError, match="--dry-run, --resume"):
+            cli.dispatch(args, self.cfg)
+        self.assertEqual(list(self.db0.migrations), [])
+        self.assertFalse(os.path.exists(queuefname))
+
+    def test_upgrade_profile(self):
+        self.db0.migrations.extend(["INITIAL"])
+        proffname = os.path.join(os.path.dirname(self.migrant_ini), "out.prof")
+        args = cli.parser.parse_args(
+            ["test", "upgrade", "-j", "2", "--profile", proffname]
+        )
+        cli.dispatch(args, self.cfg)
+
+        # Merged profile includes work, done in pool workers
+        stats = pstats.Stats(proffname)
+        self.assertIn("_update", {func[2] for func in stats.stats})
+        log = self.logstream.getvalue()
+        self.assertIn("Top 10 functions by own time:", log)
+        self.assertIn("Cumulative time per migration script:", log)
+        self.assertIn("s cccc_third", log)
+
+    def test_upgrade_progress(self):
+        args = cli.parser.parse_args(["test", "upgrade", "--progress"])
+        cli.dispatch(args, self.cfg)
+
+        log = self.logstream.getvalue()
+        self.assertIn("Processed 1/1 databases, 0 failed", log)
+
+    def test_upgrade_progress_shard(self):
+        # Backend counts whole fleet, not the shard
+        args = cli.parser.parse_args(
+            ["test", "upgrade", "--progress", "--shard", "1/1"]
+        )
+        cli.dispatch(args, self.cfg)
+
+        log = self.logstream.getvalue()
+        self.assertIn("Processed 1 databases, 0 failed", log)
+        self.assertIn("ETA ?", log)
+
+    def test_upgrade_keep_going_failed(self):
+        self.db0.migrations.extend(["INITIAL", "aaaa_first"])
+        self.db0.data.update({"value": "a"})
+        # Missing data breaks downgrade of db1
+        db1 = MockedDb("db1", multiprocessing.Manager())
+        db1.migrations.extend(["INITIAL", "aaaa_first"])
+        self.backend.dbs.insert(0, db1)
+
+        args = cli.parser.parse_args(
+            ["test", "upgrade", "--keep-going", "--revision", "INITIAL"]
+        )
+        with pytest.raises(exceptions.MigrationFailed):
+            cli.dispatch(args, self.cfg)
+
+        self.assertEqual(list(self.db0.migrations), ["INITIAL"])
+        self.assertEqual(list(db1.migrations), ["INITIAL", "aaaa_first"])
+
+    def test_stamp_upgrade(self):
+        self.db0.migrations.extend(["aaaa_first"])
+        self.db0.data.update({"value": "a"})
+
+        args = cli.parser.parse_args(["test", "upgrade", "--stamp"])
+        cli.dispatch(args, self.cfg)
+
+        self.assertEqual(
+            list(self.db0.migrations), ["aaaa_first", "bbbb_second", "cccc_third"]
+        )
+        self.assertEqual(dict(self.db0.data), {"value": "a"})
+
+    def test_stamp_downgrade(self):
+        self.db0.migrations.extend(
+            ["INITIAL", "aaaa_first", "bbbb_second", "cccc_third"]
+        )
+
+        args = cli.parser.parse_args(
+            ["test", "upgrade", "--stamp", "--revision", "aaaa_first"]
+        )
+        cli.dispatch(args, self.cfg)
+
+        self.assertEqual(list(self.db0.migrations), ["INITIAL", "aaaa_first"])
+        self.assertEqual(dict(self.db0.data), {})
+
     def test_test(self):
         self.db0.migrations = ["INITIAL", "aaaa_first", "bbbb_second", "cccc_third"]
         self.db0.data = {"hello": "world", "value": "c"}
@@ -233,6 +490,15 @@ class UpgradeTest(unittest.TestCase):
         assert "Testing downgrade" in log
         assert "Testing completed" in log
 
+    def test_test_parallel(self):
+        m = multiprocessing.Manager()
+        self.backend.dbs.append(MockedDb("db1", m))
+
+        cli.main(["-c", self.migrant_ini, "test", "test", "-j", "2"])
+
+        log = self.logstream.getvalue()
+        assert "Tested 2 databases, 0 failed" in log
+
 
 class InitTest(unittest.TestCase):
     def setUp(self):
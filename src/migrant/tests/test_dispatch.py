@@ -0,0 +1,124 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+from typing import Iterator, List
+import multiprocessing.pool
+import threading
+import time
+
+import pytest
+
+from migrant import dispatch
+
+
+def test_imap_bounded_is_lazy() -> None:
+    # GIVEN
+    taken: List[int] = []
+    backlog: List[int] = []
+    lock = threading.Lock()
+
+    def items() -> Iterator[int]:
+        for n in range(100):
+            taken.append(n)
+            yield n
+
+    def work(n: int) -> int:
+        with lock:
+            # Number of items taken from generator, but not completed yet
+            backlog.append(len(taken) - n)
+        time.sleep(0.001)
+        return n * 2
+
+    # WHEN
+    with multiprocessing.pool.ThreadPool(2) as pool:
+        results = dispatch.imap_bounded(pool, work, items(), 4)
+        first = next(results)
+        taken_at_first = len(taken)
+        rest = list(results)
+
+    # THEN
+    assert taken_at_first <= 5
+    assert sorted([first] + rest) == [n * 2 for n in range(100)]
+    assert max(backlog) <= 5
+
+
+def test_imap_bounded_group_limit() -> None:
+    # GIVEN
+    running = {"a": 0, "b": 0}
+    peak = {"a": 0, "b": 0}
+    lock = threading.Lock()
+
+    def work(item: str) -> str:
+        group = item[0]
+        with lock:
+            running[group] += 1
+            peak[group] = max(peak[group], running[group])
+        time.sleep(0.01)
+        with lock:
+            running[group] -= 1
+        return item
+
+    items = ["a1", "a2", "a3", "a4", "b1", "b2", "b3", "b4"]
+
+    # WHEN
+    with multiprocessing.pool.ThreadPool(4) as pool:
+        results = list(
+            dispatch.imap_bounded(
+                pool, work, items, 4, group_of=lambda i: i[0], group_limit=2
+            )
+        )
+
+    # THEN
+    assert sorted(results) == items
+    assert peak == {"a": 2, "b": 2}
+
+
+def test_imap_bounded_error() -> None:
+    def work(n: int) -> int:
+        if n == 3:
+            raise ValueError(n)
+        return n
+
+    with multiprocessing.pool.ThreadPool(2) as pool:
+        with pytest.raises(ValueError):
+            list(dispatch.imap_bounded(pool, work, range(10), 2))
+
+
+def test_imap_pulled() -> None:
+    # GIVEN
+    items = ["a1", "a2", "a3", "b1", "b2"]
+    pulled: List[int] = []
+    running = {"a": 0, "b": 0}
+    peak = {"a": 0, "b": 0}
+    lock = threading.Lock()
+
+    def pull(full):
+        # Number of items pulled, but not completed yet
+        with lock:
+            pulled.append(sum(running.values()))
+        for item in items:
+            if item[0] not in full:
+                items.remove(item)
+                return item[0], item
+        return None
+
+    def work(item: str) -> str:
+        group = item[0]
+        with lock:
+            running[group] += 1
+            peak[group] = max(peak[group], running[group])
+        time.sleep(0.01)
+        with lock:
+            running[group] -= 1
+        return item
+
+    # WHEN
+    with multiprocessing.pool.ThreadPool(2) as pool:
+        results = list(dispatch.imap_pulled(pool, work, pull, 2, group_limit=1))
+
+    # THEN
+    assert sorted(results) == ["a1", "a2", "a3", "b1", "b2"]
+    assert peak == {"a": 1, "b": 1}
+    assert max(pulled) <= 2
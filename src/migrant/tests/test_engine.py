@@ -3,15 +3,26 @@
 # Copyright 2014 by Shoobx, Inc.
 #
 ###############################################################################
-from typing import List, Dict, Generator
+from typing import List, Dict, Generator, Optional
+import io
+import multiprocessing
 import os
+import pickle
+import sqlite3
+import threading
 import unittest
 import time
 
 import mock
+import pytest
 
-from migrant import exceptions
+from migrant import exceptions, events, workqueue
+from migrant import engine as engine_module
 from migrant.engine import MigrantEngine
+from migrant.journal import Journal
+from migrant.profiling import ProfileStats
+from migrant.progress import ProgressReporter
+from migrant.workqueue import SQLiteWorkQueue
 from migrant.backend import MigrantBackend
 from migrant.repository import Script, Repository
 
@@ -62,6 +73,28 @@ class MigrantEngineTest(unittest.TestCase):
         actions = engine.calc_actions(None, "b")
         self.assertEqual(actions, [("-", "e"), ("-", "d")])
 
+    def test_calc_actions_cached(self):
+        engine = _make_engine(["a", "b", "x"], ["a", "b", "c", "d"])
+        actions = engine.calc_actions(None, "d")
+        self.assertEqual(actions, [("+", "c"), ("+", "d")])
+
+        # Same state, differently ordered and with unknown migrations, reuses
+        # the plan
+        engine.backend.list_migrations.return_value = ["b", "y", "a"]
+        actions.append(("+", "e"))
+        self.assertEqual(engine.calc_actions(None, "d"), [("+", "c"), ("+", "d")])
+        self.assertEqual(len(engine._plans), 1)
+
+        self.assertEqual(engine.calc_actions(None, "b"), [])
+        self.assertEqual(len(engine._plans), 2)
+
+    def test_initialize_db(self):
+        engine = _make_engine([], ["a", "b"])
+        engine.initialize_db("db1", "b")
+        engine.backend.push_migrations.assert_called_once_with(
+            "db1", ["INITIAL", "a", "b"]
+        )
+
     def test_revert_actions(self):
         engine = _make_engine([], [])
         reverted = engine.revert_actions([("-", "a"), ("+", "b")])
@@ -126,6 +159,41 @@ class MigrantEngineTest(unittest.TestCase):
             "db2 c after down",
         ]
 
+    def test_test_failures(self):
+        log = []
+        engine = _make_engine(["a", "b"], ["a", "b", "c", "d"], log)
+        script = engine.repository.load_script("c")
+
+        def test_after_up(db):
+            if db == "db1":
+                raise ValueError("Broken")
+
+        script.test_after_up = test_after_up
+
+        with self.assertRaises(exceptions.MigrationTestFailed) as cm:
+            engine.test()
+
+        self.assertEqual(str(cm.exception), "Migration tests failed for: db1")
+        # Failure on first database did not prevent testing of the second one
+        self.assertIn("db2 c after down", log)
+
+    def test_test_connection_failures(self):
+        log = []
+        engine = _make_engine(["a", "b"], ["a", "b", "c", "d"], log)
+
+        def list_migrations(db):
+            if db == "db1":
+                raise RuntimeError("Connection lost")
+            return ["a", "b"]
+
+        engine.backend.list_migrations = list_migrations
+
+        with self.assertRaises(exceptions.MigrationTestFailed) as cm:
+            engine.test()
+
+        self.assertEqual(str(cm.exception), "Migration tests failed for: db1")
+        self.assertIn("db2 c after down", log)
+
 
 class ScriptMock:
     def __init__(self, name, log):
@@ -159,6 +227,7 @@ def _make_engine(migrations, scripts, log=None):
     backend = mock.Mock()
     backend.list_migrations.return_value = migrations
     backend.begin = lambda db: db
+    backend.database_key = str
 
     backend.generate_test_connections.return_value = ["db1", "db2"]
 
@@ -166,6 +235,7 @@ def _make_engine(migrations, scripts, log=None):
     repository = mock.Mock()
     repository.list_script_ids.return_value = scripts
     repository.load_script = scriptmodules.__getitem__
+    repository.script_name = lambda sid: scriptmodules[sid].name
 
     engine = MigrantEngine(backend, repository, {})
     return engine
@@ -177,6 +247,7 @@ class MultiDbBackend(MigrantBackend[str, str]):
         self.dbs = dbs
         self.logfname = logfname
         self.unavailable_dbs: List[str] = []
+        self.broken_dbs: List[str] = []
         for db in dbs:
             self._applied[db] = ["INITIAL"]
 
@@ -189,6 +260,8 @@ class MultiDbBackend(MigrantBackend[str, str]):
         return self._applied.get(db, [])
 
     def push_migration(self, db, migration):
+        if db in self.broken_dbs:
+            raise RuntimeError(f"{db} is broken")
         migrations = self._applied.setdefault(db, [])
         migrations.append(migration)
 
@@ -203,6 +276,41 @@ class MultiDbBackend(MigrantBackend[str, str]):
             yield db
 
 
+class CatalogBackend(MultiDbBackend):
+    """Backend, that knows applied migrations without connecting"""
+
+    def __init__(self, dbs: List[str], logfname: str) -> None:
+        super().__init__(dbs, logfname)
+        self.uncataloged: List[str] = []
+        self.begun: List[str] = []
+
+    def begin(self, db: str) -> str:
+        self.begun.append(db)
+        return super().begin(db)
+
+    def bulk_list_migrations(self, dbs: List[str]) -> List[Optional[List[str]]]:
+        return [None if db in self.uncataloged else self._applied[db] for db in dbs]
+
+
+class FingerprintBackend(MultiDbBackend):
+    """Backend, that stores state fingerprints"""
+
+    def __init__(self, dbs: List[str], logfname: str) -> None:
+        super().__init__(dbs, logfname)
+        self.fingerprints: Dict[str, str] = {}
+        self.listed: List[str] = []
+
+    def list_migrations(self, db: str) -> List[str]:
+        self.listed.append(db)
+        return super().list_migrations(db)
+
+    def read_fingerprint(self, db: str) -> Optional[str]:
+        return self.fingerprints.get(db)
+
+    def write_fingerprint(self, db: str, fingerprint: str) -> None:
+        self.fingerprints[db] = fingerprint
+
+
 class TimedScript(Script):
     def __init__(self, name: str, timemap: Dict[str, float], logfname: str) -> None:
         self.name = name
@@ -216,6 +324,33 @@ class TimedScript(Script):
             f.write(f"{db}: Upgraded to {self.name} ({tosleep}s)\n")
 
 
+class LoggedScript(TimedScript):
+    def up(self, db):
+        with open(self._logfname, "a") as f:
+            f.write(f"{db}: start\n")
+        time.sleep(self._timemap.get(db, 0))
+        with open(self._logfname, "a") as f:
+            f.write(f"{db}: end\n")
+
+
+class LimitedScript(LoggedScript):
+    max_concurrency = 1
+
+
+class LimitedRepo(Repository):
+    def __init__(self, timemap: Dict[str, float], logfname: str) -> None:
+        self.timemap = timemap
+        self.logfname = logfname
+
+    def list_script_ids(self) -> List[str]:
+        return ["script1", "script2"]
+
+    def load_script(self, scriptid: str) -> Script:
+        if scriptid == "script2":
+            return LimitedScript(scriptid, self.timemap, self.logfname)
+        return TimedScript(scriptid, self.timemap, self.logfname)
+
+
 class MultiDbRepo(Repository):
     def __init__(self, timemap: Dict[str, float], logfname: str) -> None:
         self.timemap = timemap
@@ -228,6 +363,19 @@ class MultiDbRepo(Repository):
         return TimedScript(scriptid, self.timemap, self.logfname)
 
 
+class GroupedBackend(MultiDbBackend):
+    thread_safe = True
+
+    def connection_group(self, db: str) -> Optional[str]:
+        # Databases are named after their host
+        return db.split("-")[0]
+
+
+class LoggedRepo(MultiDbRepo):
+    def load_script(self, scriptid: str) -> Script:
+        return LoggedScript(scriptid, self.timemap, self.logfname)
+
+
 def test_concurrent_upgrade_multiprocess(tmp_path) -> None:
     # GIVEN
 
@@ -281,6 +429,120 @@ def test_concurrent_upgrade_singleprocess(tmp_path) -> None:
     ]
 
 
+def test_concurrent_upgrade_threads(tmp_path) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2", "db3"], logfname)
+    backend.thread_safe = True
+    repository = MultiDbRepo({"db1": 0.1, "db2": 0.01, "db3": 0.05}, logfname)
+    engine = MigrantEngine(backend, repository, {}, processes=2, executor="thread")
+
+    # WHEN
+    engine.update()
+
+    # THEN
+    with open(logfname, "r") as f:
+        log = f.read().strip().split("\n")
+
+    # Longest task executed last
+    assert log == [
+        "db2: Upgraded to script1 (0.01s)",
+        "db3: Upgraded to script1 (0.05s)",
+        "db1: Upgraded to script1 (0.1s)",
+    ]
+    # Threads work with the same backend
+    assert backend._applied["db1"] == ["INITIAL", "script1"]
+
+
+def test_pool_call(tmp_path) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2"], logfname)
+    repository = MultiDbRepo({}, logfname)
+    engine = MigrantEngine(
+        backend, repository, {}, processes=2, observer=events.EventBuffer()
+    )
+    unobserved = MigrantEngine(backend, repository, {}, processes=2)
+
+    # WHEN
+    # Worker gets engine once and tasks carry database names only
+    worker = pickle.loads(pickle.dumps(engine))
+    engine_module._init_worker(worker)
+    try:
+        result1, events1, _ = engine_module._pool_call("_update", ("script1",), "db1")
+        result2, events2, _ = engine_module._pool_call("_update", ("script1",), "db2")
+        engine_module._init_worker(pickle.loads(pickle.dumps(unobserved)))
+        result3, events3, _ = engine_module._pool_call("_update", ("script1",), "db1")
+    finally:
+        engine_module._init_worker(None)  # type: ignore
+
+    # THEN
+    assert (result1.db, result1.status) == ("db1", "succeeded")
+    assert (result2.db, result2.status) == ("db2", "succeeded")
+    assert events1[0].kind == "db_started"
+    assert all(event.db == "db2" for event in events2)
+    assert worker.backend._applied["db2"] == ["INITIAL", "script1"]
+    # Without observer in the parent, no events are collected
+    assert (result3.db, result3.status) == ("db1", "succeeded")
+    assert events3 == []
+
+
+def test_thread_executor_unsafe_backend(tmp_path) -> None:
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1"], logfname)
+    repository = MultiDbRepo({}, logfname)
+    with pytest.raises(exceptions.ConfigurationError):
+        MigrantEngine(backend, repository, {}, processes=2, executor="thread")
+
+
+def test_schedule_by_cost(tmp_path) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2", "db3", "db4"], logfname)
+    costs = {"db1": 1, "db2": 10, "db3": 1, "db4": 5}
+    backend.estimate_cost = costs.__getitem__  # type: ignore
+    repository = MultiDbRepo({}, logfname)
+    engine = MigrantEngine(backend, repository, {}, processes=1, schedule="cost")
+
+    # WHEN
+    engine.update()
+
+    # THEN
+    with open(logfname, "r") as f:
+        log = f.read().strip().split("\n")
+
+    # Costliest databases first, equal ones in original order
+    assert log == [
+        "db2: Upgraded to script1 (0s)",
+        "db4: Upgraded to script1 (0s)",
+        "db1: Upgraded to script1 (0s)",
+        "db3: Upgraded to script1 (0s)",
+    ]
+
+
+@pytest.mark.parametrize("executor", ["process", "thread"])
+def test_script_max_concurrency(tmp_path, executor) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2", "db3"], logfname)
+    backend.thread_safe = True
+    repository = LimitedRepo({"db1": 0.05, "db2": 0.05, "db3": 0.05}, logfname)
+    engine = MigrantEngine(backend, repository, {}, processes=3, executor=executor)
+
+    # WHEN
+    engine.update()
+
+    # THEN
+    with open(logfname, "r") as f:
+        log = [line for line in f.read().strip().split("\n") if "script1" not in line]
+
+    # Limited script never runs for more than one database at once
+    assert len(log) == 6
+    for start, end in zip(log[::2], log[1::2]):
+        assert start.endswith("start")
+        assert end == start.replace("start", "end")
+
+
 def test_skip_unavailable(tmp_path) -> None:
     # GIVEN
     logfname = os.path.join(tmp_path, "migration.log")
@@ -301,3 +563,513 @@ def test_skip_unavailable(tmp_path) -> None:
     assert log == [
         "db2: Upgraded to script1 (0.01s)",
     ]
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_keep_going(tmp_path, processes) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2", "db3", "db4"], logfname)
+    backend.unavailable_dbs = ["db4"]
+    backend.broken_dbs = ["db1"]
+    repository = MultiDbRepo({}, logfname)
+    engine = MigrantEngine(
+        backend, repository, {}, processes=processes, keep_going=True
+    )
+
+    # WHEN
+    result = engine.update()
+
+    # THEN
+    with open(logfname, "r") as f:
+        log = sorted(f.read().strip().split("\n"))
+    assert log == [
+        "db1: Upgraded to script1 (0s)",
+        "db2: Upgraded to script1 (0s)",
+        "db3: Upgraded to script1 (0s)",
+    ]
+
+    assert sorted(r.db for r in result.succeeded) == ["db2", "db3"]
+    assert [(r.db, r.error) for r in result.failed] == [
+        ("db1", "RuntimeError('db1 is broken')")
+    ]
+    assert [r.db for r in result.skipped] == ["db4"]
+    summary = result.to_dict()
+    assert (summary["succeeded"], summary["failed"], summary["skipped"]) == (2, 1, 1)
+    assert len(summary["databases"]) == 4
+
+
+def test_failure_stops_update(tmp_path) -> None:
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2"], logfname)
+    backend.broken_dbs = ["db1"]
+    repository = MultiDbRepo({}, logfname)
+    engine = MigrantEngine(backend, repository, {}, processes=1)
+
+    with pytest.raises(RuntimeError):
+        engine.update()
+
+    assert backend._applied["db2"] == ["INITIAL"]
+
+
+def test_prefetch_skips_current(tmp_path) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = CatalogBackend(["db1", "db2", "db3", "db4"], logfname)
+    backend._applied["db2"] = ["INITIAL", "script1"]
+    backend._applied["db3"] = ["INITIAL", "script1"]
+    backend._applied["db4"] = []
+    backend.uncataloged = ["db3"]
+    repository = MultiDbRepo({}, logfname)
+    engine = MigrantEngine(backend, repository, {}, processes=1)
+
+    # WHEN
+    result = engine.update()
+
+    # THEN
+    # Up-to-date db2 is not even connected to
+    assert backend.begun == ["db1", "db3", "db4"]
+    assert [(r.db, r.error) for r in result.skipped] == [("db2", "up-to-date")]
+    assert backend._applied["db1"] == ["INITIAL", "script1"]
+    assert backend._applied["db4"] == ["INITIAL", "script1"]
+
+    # Status connects only to databases, missing from catalog
+    backend.begun = []
+    backend._applied["db1"] = ["INITIAL"]
+    assert engine.status() == 1
+    assert backend.begun == ["db3"]
+
+
+def test_fingerprint_skips_current(tmp_path) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = FingerprintBackend(["db1", "db2"], logfname)
+    repository = MultiDbRepo({}, logfname)
+    engine = MigrantEngine(backend, repository, {}, processes=1)
+
+    # WHEN
+    engine.update()
+
+    # THEN
+    assert set(backend.fingerprints) == {"db1", "db2"}
+    assert backend.fingerprints["db1"] == engine.fingerprint("script1")
+    assert engine.fingerprint("script1") != engine.fingerprint("INITIAL")
+
+    # Migrated databases are not listed anymore
+    backend.listed = []
+    engine.update()
+    assert engine.status() == 0
+    assert backend.listed == []
+
+    # Migrations are listed again when fingerprint does not match
+    assert engine.status("INITIAL") == 2
+    assert backend.listed == ["db1", "db2"]
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_pending_actions(tmp_path, processes) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2", "db3", "db4"], logfname)
+    backend.unavailable_dbs = ["db3"]
+    backend._applied["db2"] = ["INITIAL", "script1"]
+    backend._applied["db4"] = []
+    repository = MultiDbRepo({}, logfname)
+    engine = MigrantEngine(backend, repository, {}, processes=processes)
+
+    # WHEN
+    pending = engine.pending_actions()
+
+    # THEN
+    assert pending == {
+        "db1": [("+", "script1")],
+        "db2": [],
+        "db3": None,
+        "db4": [],
+    }
+    assert engine.status() == 1
+    # Uninitialized database is left intact
+    assert backend._applied["db4"] == []
+
+
+def test_pending_actions_serial_by_default(tmp_path) -> None:
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2"], logfname)
+    engine = MigrantEngine(backend, MultiDbRepo({}, logfname), {})
+
+    # Library callers, that do not ask for processes, get no pool
+    with mock.patch.object(engine_module.multiprocessing, "Pool") as pool:
+        assert engine.status() == 2
+    assert not pool.called
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_observer_events(tmp_path, processes) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2", "db3"], logfname)
+    backend.unavailable_dbs = ["db3"]
+    repository = MultiDbRepo({}, logfname)
+    observer = events.EventBuffer()
+    engine = MigrantEngine(
+        backend, repository, {}, processes=processes, observer=observer
+    )
+
+    # WHEN
+    engine.update()
+
+    # THEN
+    byname: Dict[str, List[events.Event]] = {}
+    for event in observer.events:
+        byname.setdefault(event.db, []).append(event)
+
+    db1 = byname["db1"]
+    assert [(e.kind, e.call or e.script) for e in db1] == [
+        ("db_queued", None),
+        ("db_started", None),
+        ("backend_call", "begin"),
+        ("backend_call", "read_fingerprint"),
+        ("backend_call", "list_migrations"),
+        ("backend_call", "list_migrations"),
+        ("script_started", "script1"),
+        ("script_finished", "script1"),
+        ("backend_call", "write_fingerprint"),
+        ("backend_call", "commit"),
+        ("db_committed", None),
+    ]
+    finished = [
+        e for e in db1 if e.kind not in ("db_queued", "db_started", "script_started")
+    ]
+    assert all(e.duration is not None for e in finished)
+    assert len(byname["db2"]) == len(db1)
+    assert [e.kind for e in byname["db3"]] == ["db_queued", "db_started", "db_skipped"]
+
+
+class RecordingProgress(ProgressReporter):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.lines: List[str] = []
+
+    def _report(self) -> None:
+        self.lines.append(self.format())
+
+
+def test_progress_more_dbs_than_window(tmp_path) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    dbs = [f"db{n}" for n in range(20)]
+    backend = MultiDbBackend(dbs, logfname)
+    repository = MultiDbRepo({}, logfname)
+    progress = RecordingProgress(2, stream=io.StringIO(), total=len(dbs))
+    engine = MigrantEngine(
+        backend, repository, {}, processes=2, window=4, observer=progress
+    )
+
+    # WHEN
+    result = engine.update()
+
+    # THEN
+    assert len(result.succeeded) == 20
+    # Databases are taken lazily, yet total is reported throughout the run
+    assert progress.queued == progress.done == 20
+    assert all("/20 databases" in line for line in progress.lines)
+    assert progress.lines[-1].startswith("Processed 20/20 databases, 0 failed")
+    assert progress.eta() == 0
+
+
+@pytest.mark.parametrize("executor", ["process", "thread"])
+def test_per_group_limit(tmp_path, executor) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    dbs = ["hosta-1", "hosta-2", "hosta-3", "hostb-1", "hostb-2"]
+    backend = GroupedBackend(dbs, logfname)
+    repository = LoggedRepo({db: 0.05 for db in dbs}, logfname)
+    engine = MigrantEngine(
+        backend, repository, {}, processes=4, executor=executor, group_limit=1
+    )
+
+    # WHEN
+    result = engine.update()
+
+    # THEN
+    assert len(result.succeeded) == 5
+    with open(logfname, "r") as f:
+        log = f.read().strip().split("\n")
+
+    # Both hosts are served at once, but one database of each at a time
+    assert sorted(log[:2]) == ["hosta-1: start", "hostb-1: start"]
+    for host in ["hosta", "hostb"]:
+        hostlog = [line for line in log if line.startswith(host)]
+        for start, end in zip(hostlog[::2], hostlog[1::2]):
+            assert start.endswith("start")
+            assert end == start.replace("start", "end")
+
+    for limit in [0, -1]:
+        with pytest.raises(exceptions.ConfigurationError):
+            MigrantEngine(backend, repository, {}, group_limit=limit)
+
+
+def test_journal_resume(tmp_path) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2", "db3"], logfname)
+    backend.broken_dbs = ["db2"]
+    repository = MultiDbRepo({}, logfname)
+    journal = Journal(os.path.join(tmp_path, "journal.sqlite"))
+
+    # Dry run records nothing
+    MigrantEngine(
+        backend, repository, {}, dry_run=True, processes=2, journal=journal
+    ).update()
+    fingerprint = engine_module.EngineBase(repository, {}).fingerprint("script1")
+    assert not journal.is_completed(fingerprint, "db1")
+
+    engine = MigrantEngine(
+        backend, repository, {}, processes=2, keep_going=True, journal=journal
+    )
+    engine.update()
+
+    # WHEN
+    backend.broken_dbs = []
+    resumed = MigrantEngine(
+        backend, repository, {}, processes=2, journal=journal, resume=True
+    )
+    result = resumed.update()
+
+    # THEN
+    assert sorted((r.db, r.error) for r in result.skipped) == [
+        ("db1", "journaled"),
+        ("db3", "journaled"),
+    ]
+    assert [r.db for r in result.succeeded] == ["db2"]
+    # Other target revision is not journaled
+    result = resumed.update("INITIAL")
+    assert len(result.succeeded) == 3
+
+
+def test_shard(tmp_path) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    dbs = [f"db{n}" for n in range(20)]
+    backend = MultiDbBackend(dbs, logfname)
+    repository = MultiDbRepo({}, logfname)
+
+    # WHEN
+    shards = [
+        MigrantEngine(backend, repository, {}, processes=1, shard=(k, 3)).update()
+        for k in (1, 2, 3)
+    ]
+
+    # THEN
+    # Each database is processed by exactly one shard
+    processed = [sorted(r.db for r in result.results) for result in shards]
+    assert all(processed)
+    assert sorted(sum(processed, [])) == sorted(dbs)
+    # Assignment is stable
+    engine = MigrantEngine(backend, repository, {}, processes=1, shard=(2, 3))
+    assert sorted(db for db in dbs if engine.in_shard(db)) == processed[1]
+
+    with pytest.raises(exceptions.ConfigurationError):
+        MigrantEngine(backend, repository, {}, shard=(4, 3))
+
+
+class Database:
+    # No __str__, default representation includes memory address
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+
+class KeyedBackend(MigrantBackend[Database, Database]):
+    def database_key(self, db: Database) -> str:
+        return db.name
+
+
+def test_database_key(tmp_path) -> None:
+    # GIVEN
+    repository = MultiDbRepo({}, os.path.join(tmp_path, "migration.log"))
+    dbs = [Database(f"db{n}") for n in range(20)]
+    # Other host gets other objects for the same databases
+    copies = pickle.loads(pickle.dumps(dbs))
+
+    # WHEN
+    engine = MigrantEngine(KeyedBackend(), repository, {}, processes=1, shard=(1, 3))
+    queue = SQLiteWorkQueue(os.path.join(tmp_path, "queue.sqlite"))
+    queue.publish("script1", "fp1", dbs, key_of=engine._key)
+    queue.publish("script1", "fp1", copies, key_of=engine._key)
+
+    # THEN
+    assert [engine.in_shard(db) for db in dbs] == [
+        engine.in_shard(db) for db in copies
+    ]
+    assert queue.remaining() == 20
+    task = queue.lease("w1", 10, "fp1")
+    assert task is not None and task.key == "db0"
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_work_queue(tmp_path, processes) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2", "db3", "db4"], logfname)
+    backend.broken_dbs = ["db3"]
+    repository = MultiDbRepo({}, logfname)
+    queue = SQLiteWorkQueue(os.path.join(tmp_path, "queue.sqlite"))
+    engine = MigrantEngine(
+        backend, repository, {}, processes=processes, keep_going=True
+    )
+    assert engine.publish(queue) == 4
+    # Lease of dead worker expires and database is retried
+    queue.lease("dead", -1, queue.target()[1])
+
+    # WHEN
+    result = engine.work(queue, poll=0.01)
+
+    # THEN
+    assert sorted(r.db for r in result.succeeded) == ["db1", "db2", "db4"]
+    assert [r.db for r in result.failed] == ["db3"]
+    assert queue.remaining() == 0
+    assert len(queue.report().results) == 4
+
+
+def test_work_queue_poll_keeps_pool(tmp_path) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2", "db3"], logfname)
+    repository = MultiDbRepo({}, logfname)
+    queue = SQLiteWorkQueue(os.path.join(tmp_path, "queue.sqlite"))
+    engine = MigrantEngine(backend, repository, {}, processes=2)
+    engine.publish(queue)
+    # Other worker holds a lease for a while, then dies
+    queue.lease("other", 0.5, queue.target()[1])
+
+    # WHEN
+    with mock.patch.object(
+        engine_module.multiprocessing, "Pool", wraps=multiprocessing.Pool
+    ) as pool:
+        result = engine.work(queue, poll=0.05)
+
+    # THEN
+    # Queue is polled for expired lease with the same pool
+    assert pool.call_count == 1
+    assert sorted(r.db for r in result.succeeded) == ["db1", "db2", "db3"]
+
+
+@pytest.mark.parametrize("group_limit", [None, 1])
+def test_work_queue_leases_free_workers_only(tmp_path, group_limit) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    dbs = [f"hosta-{n}" for n in range(8)] + ["hostb-1", "hostb-2"]
+    backend = GroupedBackend(dbs, logfname)
+    repository = MultiDbRepo({db: 0.05 for db in dbs}, logfname)
+    fname = os.path.join(tmp_path, "queue.sqlite")
+    queue = SQLiteWorkQueue(fname)
+    engine = MigrantEngine(
+        backend, repository, {}, processes=2, group_limit=group_limit
+    )
+    engine.publish(queue)
+
+    leased: List[int] = []
+    stop = threading.Event()
+
+    def watch() -> None:
+        conn = sqlite3.connect(fname, timeout=60)
+        while not stop.wait(0.005):
+            (count,) = conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status=?", (workqueue.LEASED,)
+            ).fetchone()
+            leased.append(count)
+        conn.close()
+
+    # WHEN
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    try:
+        result = engine.work(queue)
+    finally:
+        stop.set()
+        watcher.join()
+
+    # THEN
+    # Host does not take more databases, than it has workers for
+    assert len(result.succeeded) == 10
+    assert max(leased) <= 2
+
+
+def test_work_queue_stops_on_failure(tmp_path) -> None:
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2"], logfname)
+    backend.broken_dbs = ["db1"]
+    repository = MultiDbRepo({}, logfname)
+    queue = SQLiteWorkQueue(os.path.join(tmp_path, "queue.sqlite"))
+    engine = MigrantEngine(backend, repository, {}, processes=1)
+
+    with pytest.raises(exceptions.MigrationFailed):
+        engine.coordinate(queue)
+
+    # Failure is recorded, so that other workers do not retry it
+    assert [(r.db, r.status) for r in queue.report().results] == [("db1", "failed")]
+    assert queue.remaining() == 1
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"dry_run": True},
+        {"stamp": True},
+        {"schedule": "cost"},
+        {"resume": True},
+    ],
+)
+def test_work_queue_unsupported_modes(tmp_path, options) -> None:
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2"], logfname)
+    repository = MultiDbRepo({}, logfname)
+    queue = SQLiteWorkQueue(os.path.join(tmp_path, "queue.sqlite"))
+    MigrantEngine(backend, repository, {}, processes=1).publish(queue)
+    engine = MigrantEngine(backend, repository, {}, processes=1, **options)
+
+    # Workers would migrate databases for real, in order of publishing
+    with pytest.raises(exceptions.ConfigurationError):
+        engine.coordinate(queue)
+    with pytest.raises(exceptions.ConfigurationError):
+        engine.work(queue)
+    assert queue.remaining() == 2
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_profile(tmp_path, processes) -> None:
+    # GIVEN
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1", "db2", "db3"], logfname)
+    repository = MultiDbRepo({}, logfname)
+    profile = ProfileStats()
+    engine = MigrantEngine(
+        backend, repository, {}, processes=processes, profile=profile
+    )
+
+    # WHEN
+    engine.update()
+
+    # THEN
+    # Profiles of all databases are merged
+    updates = [
+        stat
+        for (fname, _, funcname), stat in profile.data.items()
+        if funcname == "_update"
+    ]
+    assert updates[0][1] == 3
+    assert any(func.endswith("(_update)") for func, *_ in profile.top_functions(100))
+
+
+def test_profile_thread_executor(tmp_path) -> None:
+    logfname = os.path.join(tmp_path, "migration.log")
+    backend = MultiDbBackend(["db1"], logfname)
+    backend.thread_safe = True
+    with pytest.raises(exceptions.ConfigurationError):
+        MigrantEngine(
+            backend,
+            MultiDbRepo({}, logfname),
+            {},
+            executor="thread",
+            profile=ProfileStats(),
+        )
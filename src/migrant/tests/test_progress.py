@@ -0,0 +1,98 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+import io
+import logging
+
+from migrant import events
+from migrant.progress import ProgressReporter
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _event(kind, duration=None):
+    return events.Event(kind, "db", "MainProcess", 0, duration=duration)
+
+
+def test_progress(caplog) -> None:
+    clock = FakeClock()
+    progress = ProgressReporter(
+        2, stream=io.StringIO(), interval=10, clock=clock, total=10
+    )
+
+    for _ in range(4):
+        progress.notify(_event(events.DB_QUEUED))
+    assert progress.format() == (
+        "Processed 0/10 databases, 0 failed, 2 in flight, 0.0 DBs/min, ETA ?"
+    )
+
+    clock.now += 60
+    progress.notify(_event(events.DB_COMMITTED, 10.0))
+    progress.notify(_event(events.DB_ABORTED, 20.0))
+    progress.notify(_event(events.DB_SKIPPED))
+
+    # 7 remaining databases at 3 databases per minute
+    assert progress.eta() == 140
+    assert progress.format() == (
+        "Processed 3/10 databases, 1 failed, 1 in flight, 3.0 DBs/min, ETA 0:02:20"
+    )
+
+
+def test_progress_unknown_total(caplog) -> None:
+    clock = FakeClock()
+    progress = ProgressReporter(2, stream=io.StringIO(), interval=10, clock=clock)
+
+    for _ in range(4):
+        progress.notify(_event(events.DB_QUEUED))
+    clock.now += 60
+    progress.notify(_event(events.DB_COMMITTED, 10.0))
+
+    # Queued databases are not the total, they are taken lazily
+    assert progress.eta() is None
+    assert progress.format() == (
+        "Processed 1 databases, 0 failed, 2 in flight, 1.0 DBs/min, ETA ?"
+    )
+
+
+def test_progress_recent_throughput(caplog) -> None:
+    clock = FakeClock()
+    progress = ProgressReporter(
+        1, stream=io.StringIO(), window=3, clock=clock, total=10
+    )
+
+    # Slow start does not affect ETA, once window is filled
+    clock.now += 600
+    for _ in range(3):
+        progress.notify(_event(events.DB_QUEUED))
+        clock.now += 10
+        progress.notify(_event(events.DB_COMMITTED, 10.0))
+
+    # 2 databases in last 20 seconds
+    assert progress.recent_throughput() == 6.0
+    assert progress.eta() == 70
+
+
+def test_progress_log_interval(caplog) -> None:
+    caplog.set_level(logging.INFO, "migrant.progress")
+    clock = FakeClock()
+    progress = ProgressReporter(1, stream=io.StringIO(), interval=10, clock=clock)
+
+    progress.notify(_event(events.DB_QUEUED))
+    progress.notify(_event(events.DB_QUEUED))
+    clock.now += 5
+    progress.notify(_event(events.DB_COMMITTED, 5.0))
+    assert caplog.messages == []
+
+    clock.now += 5
+    progress.notify(_event(events.DB_COMMITTED, 5.0))
+    progress.finish()
+    assert len(caplog.messages) == 2
+    assert caplog.messages[-1].startswith("Processed 2 databases, 0 failed")
@@ -10,7 +10,9 @@ import os
 import shutil
 import textwrap
 
-from migrant import repository
+import mock
+
+from migrant import repository, exceptions
 
 
 class RepositoryTest(unittest.TestCase):
@@ -58,3 +60,127 @@ class RepositoryTest(unittest.TestCase):
 
         revids = repo.list_script_ids()
         self.assertEqual(revids, ["a24bc", "d724a", "1babe"])
+
+    def test_load_script_cached(self):
+        repo = repository.DirectoryRepository(self.dir)
+        repo.init()
+        revid = repo.new_script("Hello, World").split("_")[0]
+
+        script = repo.load_script(revid)
+        self.assertIs(repo.load_script(revid), script)
+        # Freshly created repository reuses already loaded scripts too
+        repo2 = repository.DirectoryRepository(self.dir)
+        self.assertIs(repo2.load_script(revid), script)
+
+    def test_load_script_changed(self):
+        repo = repository.DirectoryRepository(self.dir)
+        repo.init()
+        revname = repo.new_script("Hello, World")
+        revid = revname.split("_")[0]
+
+        script = repo.load_script(revid)
+        self.assertFalse(hasattr(script.module, "changed"))
+
+        with open(os.path.join(self.dir, revname + ".py"), "a") as f:
+            f.write("changed = True\n")
+
+        script = repo.load_script(revid)
+        self.assertTrue(script.module.changed)
+
+    def test_load_script_new(self):
+        repo = repository.DirectoryRepository(self.dir)
+        repo.init()
+        first = repo.new_script("First").split("_")[0]
+        repo.load_script(first)
+
+        # Script added behind repository's back
+        with open(os.path.join(self.dir, "abcdef_second.py"), "w") as f:
+            f.write("")
+
+        self.assertEqual(repo.load_script("abcdef").name, "abcdef_second")
+
+    def test_load_script_stale_index(self):
+        repo = repository.DirectoryRepository(self.dir)
+        repo.init()
+        with open(os.path.join(self.dir, "abcdef_first.py"), "w") as f:
+            f.write("")
+        with open(os.path.join(self.dir, "fedcba_second.py"), "w") as f:
+            f.write("")
+        repo.load_script("abcdef")
+
+        # Scripts renamed and removed behind repository's back
+        os.rename(
+            os.path.join(self.dir, "abcdef_first.py"),
+            os.path.join(self.dir, "abcdef_renamed.py"),
+        )
+        os.remove(os.path.join(self.dir, "fedcba_second.py"))
+
+        self.assertEqual(repo.load_script("abcdef").name, "abcdef_renamed")
+        with self.assertRaises(exceptions.ScriptNotFoundError):
+            repo.load_script("fedcba")
+
+    def test_load_script_missing(self):
+        repo = repository.DirectoryRepository(self.dir)
+        repo.init()
+        with self.assertRaises(exceptions.ScriptNotFoundError):
+            repo.load_script("abcdef")
+
+    def test_compile(self):
+        repo = repository.DirectoryRepository(self.dir)
+        repo.init()
+        revname = repo.new_script("Hello, World")
+        revid = revname.split("_")[0]
+
+        self.assertEqual(repo.compile(), 1)
+        self.assertEqual(
+            repo.manifest(),
+            [
+                {
+                    "revid": revid,
+                    "fname": revname + ".py",
+                    "name": revname,
+                    "title": "Hello, World",
+                    "hash": mock.ANY,
+                }
+            ],
+        )
+
+        # Bundled script is loaded without compiling its source
+        with mock.patch("importlib.util.spec_from_file_location") as spec:
+            script = repository.DirectoryRepository(self.dir).load_script(revid)
+        spec.assert_not_called()
+        self.assertEqual(script.name, revname)
+        self.assertEqual(script.module.__doc__, "Hello, World")
+        self.assertIsNone(script.up(None))
+
+    def test_compile_stale(self):
+        repo = repository.DirectoryRepository(self.dir)
+        repo.init()
+        revname = repo.new_script("Hello, World")
+        revid = revname.split("_")[0]
+        repo.compile()
+
+        with open(os.path.join(self.dir, revname + ".py"), "a") as f:
+            f.write("changed = True\n")
+
+        # Changed script is loaded from source
+        script = repo.load_script(revid)
+        self.assertTrue(script.module.changed)
+
+    def test_load_script_lazy(self):
+        repo = repository.DirectoryRepository(self.dir)
+        repo.init()
+        with open(os.path.join(self.dir, "abcdef_lazy.py"), "w") as f:
+            f.write('"""Lazy script\n\nDetails"""\n')
+            f.write("max_concurrency = 2\n")
+            f.write("raise RuntimeError('executed')\n")
+
+        # Name, title and limit are known without executing the script
+        self.assertEqual(repo.script_name("abcdef"), "abcdef_lazy")
+        script = repo.load_script("abcdef")
+        self.assertEqual(script.title, "Lazy script")
+        self.assertEqual(script.max_concurrency, 2)
+        self.assertEqual(repo.script_title("abcdef"), "Lazy script")
+
+        with self.assertRaises(RuntimeError):
+            script.up(None)
@@ -0,0 +1,129 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+import os
+
+import pytest
+
+from migrant import exceptions
+from migrant.report import DbResult
+from migrant.workqueue import SQLiteWorkQueue
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_lease_expiry(tmp_path) -> None:
+    # GIVEN
+    clock = FakeClock()
+    queue = SQLiteWorkQueue(os.path.join(tmp_path, "queue.sqlite"), clock)
+    assert queue.publish("bbbb", "fp1", ["db1", "db2"]) == 2
+
+    # WHEN
+    task1 = queue.lease("w1", 10, "fp1")
+    task2 = queue.lease("w2", 10, "fp1")
+
+    # THEN
+    assert task1 is not None and task2 is not None
+    assert (task1.key, task1.db) == ("db1", "db1")
+    assert task2.key == "db2"
+    assert queue.lease("w3", 10, "fp1") is None
+    assert queue.remaining() == 2
+
+    # Heartbeat keeps lease of w1, lease of w2 expires and is taken over
+    clock.now += 8
+    queue.heartbeat("w1", 10)
+    clock.now += 8
+    task3 = queue.lease("w3", 10, "fp1")
+    assert task3 is not None and task3.key == "db2"
+    assert queue.lease("w3", 10, "fp1") is None
+
+    queue.complete(DbResult("db1", "succeeded", None, 1.5))
+    queue.complete(DbResult("db2", "failed", "RuntimeError()", 0.5))
+    assert queue.remaining() == 0
+    assert queue.report().results == [
+        DbResult("db1", "succeeded", None, 1.5),
+        DbResult("db2", "failed", "RuntimeError()", 0.5),
+    ]
+
+
+def test_republish(tmp_path) -> None:
+    fname = os.path.join(tmp_path, "queue.sqlite")
+    queue = SQLiteWorkQueue(fname)
+    with pytest.raises(exceptions.ConfigurationError):
+        queue.target()
+    queue.publish("bbbb", "fp1", ["db1", "db2"])
+    queue.complete(DbResult("db1", "succeeded"))
+    queue.complete(DbResult("db2", "failed", "error"))
+
+    # Same fingerprint retries failed databases only
+    queue.publish("bbbb", "fp1", ["db1", "db2", "db3"])
+    assert SQLiteWorkQueue(fname).target() == ("bbbb", "fp1")
+    assert queue.remaining() == 2
+    assert [r.db for r in queue.report().succeeded] == ["db1"]
+
+    # Other fingerprint starts over
+    queue.publish("cccc", "fp2", ["db1"])
+    assert queue.target() == ("cccc", "fp2")
+    assert queue.remaining() == 1
+    assert queue.report().results == []
+
+
+def test_republish_leased(tmp_path) -> None:
+    # GIVEN
+    clock = FakeClock()
+    queue = SQLiteWorkQueue(os.path.join(tmp_path, "queue.sqlite"), clock)
+    queue.publish("bbbb", "fp1", ["db1", "db2", "db3"])
+    queue.lease("w1", 10, "fp1")
+    queue.lease("w2", 10, "fp1")
+    queue.complete(DbResult("db2", "skipped", "unavailable"))
+
+    # WHEN
+    # Database, leased by running worker, would be migrated twice
+    for fingerprint in ["fp1", "fp2"]:
+        with pytest.raises(exceptions.ConfigurationError):
+            queue.publish("bbbb", fingerprint, ["db1", "db2", "db3"])
+    assert queue.remaining() == 2
+
+    # Expired lease and skipped database are retried
+    clock.now += 20
+    queue.publish("bbbb", "fp1", ["db1", "db2", "db3"])
+
+    # THEN
+    assert queue.remaining() == 3
+    assert queue.report().results == []
+    task = queue.lease("w3", 10, "fp1")
+    assert task is not None and task.key == "db1"
+
+
+def test_lease_other_fingerprint(tmp_path) -> None:
+    queue = SQLiteWorkQueue(os.path.join(tmp_path, "queue.sqlite"))
+    queue.publish("bbbb", "fp1", ["db1"])
+    queue.publish("cccc", "fp2", ["db1", "db2"])
+
+    # Worker, that read the old target, does not migrate new databases to it
+    with pytest.raises(exceptions.ConfigurationError):
+        queue.lease("w1", 10, "fp1")
+    assert queue.remaining() == 2
+
+
+def test_lease_exclude_groups(tmp_path) -> None:
+    queue = SQLiteWorkQueue(os.path.join(tmp_path, "queue.sqlite"))
+    dbs = ["hosta-1", "hosta-2", "hostb-1", "nohost"]
+    group_of = lambda db: db.split("-")[0] if "-" in db else None  # noqa: E731
+    queue.publish("bbbb", "fp1", dbs, group_of)
+
+    task = queue.lease("w1", 10, "fp1", {"hosta"})
+    assert task is not None and (task.key, task.group) == ("hostb-1", "hostb")
+    task = queue.lease("w1", 10, "fp1", {"hosta", "hostb"})
+    assert task is not None and (task.key, task.group) == ("nohost", None)
+    assert queue.lease("w1", 10, "fp1", {"hosta"}) is None
+    task = queue.lease("w1", 10, "fp1")
+    assert task is not None and task.key == "hosta-1"
@@ -0,0 +1,283 @@
+###############################################################################
+#
+# Copyright 2014 by Shoobx, Inc.
+#
+###############################################################################
+from typing import Any, Callable, Collection, Iterable, Iterator, List, NamedTuple
+from typing import Optional, Tuple
+import contextlib
+import pickle
+import sqlite3
+import threading
+import time
+
+from migrant import exceptions, report
+from migrant.report import DbResult, UpdateReport
+
+# Task statuses, besides final ones from `migrant.report`
+PENDING = "pending"
+LEASED = "leased"
+
+# Number of tasks, published in one transaction
+PUBLISH_BATCH = 1000
+
+
+class Task(NamedTuple):
+    """Database, leased from the work queue"""
+
+    # Key of the database, identifying the task
+    key: str
+    db: Any
+    # Connection group of the database, see `MigrantBackend.connection_group`
+    group: Optional[str] = None
+
+
+class WorkQueue:
+    """Queue of databases, shared by workers on many hosts
+
+    Coordinator publishes databases to migrate, and workers lease them one by
+    one. Worker extends its leases with heartbeats while it processes them.
+    Leases, that are not extended in time, e.g. because worker died, expire
+    and their databases are leased again by other workers.
+    """
+
+    def publish(
+        self,
+        target_id: str,
+        fingerprint: str,
+        dbs: Iterable[Any],
+        group_of: Optional[Callable[[Any], Optional[str]]] = None,
+        key_of: Callable[[Any], str] = str,
+    ) -> int:
+        """Publish databases to migrate to `target_id` and return their number
+
+        Databases are identified by keys, as returned by `key_of` (see
+        `MigrantBackend.database_key`). They are published with their
+        connection groups, as returned by `group_of`, so that workers can skip
+        groups they are busy with.
+
+        Publishing with different fingerprint (see `EngineBase.fingerprint`)
+        starts over. Publishing with the same one keeps databases, that
+        already succeeded, and retries failed, skipped and abandoned ones.
+        Publishing is refused, while workers hold unexpired leases.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def target(self) -> Tuple[str, str]:
+        """Return target revision and fingerprint of published databases"""
+        raise NotImplementedError  # pragma: no cover
+
+    def lease(
+        self,
+        worker: str,
+        duration: float,
+        fingerprint: str,
+        exclude: Collection[str] = (),
+    ) -> Optional[Task]:
+        """Lease next database for `duration` seconds
+
+        Worker leases only databases, published with `fingerprint` it
+        migrates them to, and not of connection groups in `exclude`. Return
+        `None`, when there is nothing to lease at the moment.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def heartbeat(self, worker: str, duration: float) -> None:
+        """Extend all leases of the worker by `duration` seconds from now"""
+        raise NotImplementedError  # pragma: no cover
+
+    def complete(self, result: DbResult) -> None:
+        """Record outcome of leased database"""
+        raise NotImplementedError  # pragma: no cover
+
+    def remaining(self) -> int:
+        """Return number of databases, that are pending or leased"""
+        raise NotImplementedError  # pragma: no cover
+
+    def report(self) -> UpdateReport:
+        """Return outcome of all completed databases"""
+        raise NotImplementedError  # pragma: no cover
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """Work queue in SQLite file, e.g. on storage, shared by all hosts
+
+    Databases are pickled to the queue, so they must be picklable, as they
+    are for process executor.
+    """
+
+    def __init__(self, fname: str, clock: Callable[[], float] = time.time) -> None:
+        self.fname = fname
+        self.clock = clock
+        # Connection is shared with heartbeat thread
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            fname, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        with self._transaction():
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                " key TEXT PRIMARY KEY,"
+                " payload BLOB NOT NULL,"
+                " status TEXT NOT NULL,"
+                " grp TEXT,"
+                " worker TEXT,"
+                " expires REAL,"
+                " error TEXT,"
+                " duration REAL)"
+            )
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # Database file is locked right away, so that workers on other hosts
+        # can not lease the same task
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def publish(
+        self,
+        target_id: str,
+        fingerprint: str,
+        dbs: Iterable[Any],
+        group_of: Optional[Callable[[Any], Optional[str]]] = None,
+        key_of: Callable[[Any], str] = str,
+    ) -> int:
+        with self._transaction():
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key='fingerprint'"
+            ).fetchone()
+            (leased,) = self.conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status=? AND expires>=?",
+                (LEASED, self.clock()),
+            ).fetchone()
+            if leased:
+                raise exceptions.ConfigurationError(
+                    f"{leased} databases are leased by running workers, "
+                    "wait for them to finish or for leases to expire"
+                )
+            if row is None or row[0] != fingerprint:
+                self.conn.execute("DELETE FROM tasks")
+            else:
+                self.conn.execute(
+                    "UPDATE tasks SET status=?, worker=NULL, expires=NULL "
+                    "WHERE status IN (?, ?, ?)",
+                    (PENDING, report.FAILED, report.SKIPPED, LEASED),
+                )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("target", target_id), ("fingerprint", fingerprint)],
+            )
+
+        count = 0
+        batch: List[Tuple[str, bytes, str, Optional[str]]] = []
+        for db in dbs:
+            group = group_of(db) if group_of else None
+            batch.append((key_of(db), pickle.dumps(db), PENDING, group))
+            count += 1
+            if len(batch) >= PUBLISH_BATCH:
+                self._insert(batch)
+                batch = []
+        self._insert(batch)
+        return count
+
+    def _insert(self, batch: List[Tuple[str, bytes, str, Optional[str]]]) -> None:
+        with self._transaction():
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO tasks (key, payload, status, grp) "
+                "VALUES (?, ?, ?, ?)",
+                batch,
+            )
+
+    def target(self) -> Tuple[str, str]:
+        with self._lock:
+            meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        if "target" not in meta:
+            raise exceptions.ConfigurationError(
+                f"Nothing is published to work queue {self.fname}"
+            )
+        return meta["target"], meta["fingerprint"]
+
+    def lease(
+        self,
+        worker: str,
+        duration: float,
+        fingerprint: str,
+        exclude: Collection[str] = (),
+    ) -> Optional[Task]:
+        now = self.clock()
+        # Groups, the worker is busy with
+        skipped = ""
+        if exclude:
+            marks = ", ".join("?" * len(exclude))
+            skipped = f"AND (grp IS NULL OR grp NOT IN ({marks})) "
+        with self._transaction():
+            published = self.conn.execute(
+                "SELECT value FROM meta WHERE key='fingerprint'"
+            ).fetchone()
+            if published is None or published[0] != fingerprint:
+                raise exceptions.ConfigurationError(
+                    "Work queue is republished for different set of scripts"
+                )
+            row = self.conn.execute(
+                "SELECT key, payload, grp FROM tasks "
+                "WHERE (status=? OR (status=? AND expires<?)) "
+                f"{skipped}ORDER BY rowid LIMIT 1",
+                (PENDING, LEASED, now, *exclude),
+            ).fetchone()
+            if row is None:
+                return None
+            key, payload, group = row
+            self.conn.execute(
+                "UPDATE tasks SET status=?, worker=?, expires=? WHERE key=?",
+                (LEASED, worker, now + duration, key),
+            )
+        return Task(key, pickle.loads(payload), group)
+
+    def heartbeat(self, worker: str, duration: float) -> None:
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE tasks SET expires=? WHERE status=? AND worker=?",
+                (self.clock() + duration, LEASED, worker),
+            )
+
+    def complete(self, result: DbResult) -> None:
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE tasks SET status=?, expires=NULL, error=?, duration=? "
+                "WHERE key=?",
+                (result.status, result.error, result.duration, result.db),
+            )
+
+    def remaining(self) -> int:
+        with self._lock:
+            (count,) = self.conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status IN (?, ?)", (PENDING, LEASED)
+            ).fetchone()
+        return count
+
+    def report(self) -> UpdateReport:
+        result = UpdateReport()
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT key, status, error, duration FROM tasks "
+                "WHERE status NOT IN (?, ?) ORDER BY rowid",
+                (PENDING, LEASED),
+            ).fetchall()
+        for row in rows:
+            result.add(DbResult(*row))
+        return result
+
+    def close(self) -> None:
+        self.conn.close()
+